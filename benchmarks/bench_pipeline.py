@@ -0,0 +1,182 @@
+''' Wall time and peak memory of each stage of `find_targets.py` on synthetic catalogs.
+
+The stages (catalog load, index and pre-filter, target construction, transforms, altaz
+sampling, `check_observable`, the analytic `altitude_range`, planets, Moon and scores,
+schedule, report and plotting) are run in-process on random catalogs of each `--sizes` and, for the
+time-dependent stages, for each `--durations` (the time grid of `time_grid` has
+``max(6, int(duration*12)) + 3`` samples). Each stage is timed `--repeat` times (minimum
+reported), then run once more under tracemalloc for its peak memory. E.g., to size the kiosk hardware:
+
+    $ python benchmarks/bench_pipeline.py --sizes 200 10000 100000 --durations 0.5 2 6
+'''
+import argparse
+import json
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import astroplan as ap
+import astropy.units as u
+import numpy as np
+import pandas as pd
+from astropy.coordinates import EarthLocation, SkyCoord, get_body
+from astropy.time import Time
+
+TOP = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(TOP))
+import find_targets as ft  # noqa: E402
+
+OBSTIME = Time("2021-11-12T11:30:00")  # 20:30 in Seoul
+LOCATION = (127, 37.5)
+TYPES = ["gal-S", "gal-E", "gal-SB", "Neb-P", "Neb-HII", "cl-O", "cl-G", "MW"]
+
+
+def make_catalog(size, path, seed=0):
+    ''' Random catalog of `size` objects (uniform on the sky) in the format of
+    `amastro_catalog_radec.csv`, saved to `path`.
+    '''
+    rng = np.random.default_rng(seed)
+    ids = np.char.add(np.where(np.arange(size) % 2, "C", "M"), np.arange(1, size + 1).astype(str))
+    names = np.where(rng.random(size) < 0.3, "Nickname", None)
+    cat = pd.DataFrame({
+        "ID": ids,
+        "Other ID": np.char.add("NGC ", np.arange(size).astype(str)),
+        "Name": names,
+        "Type": rng.choice(TYPES, size),
+        "Distance (kly)": np.round(rng.uniform(1, 1e5, size), 1),
+        "Constellation": "Nowhere",
+        "Mag": np.round(rng.uniform(3, 14, size), 1),
+        "RA": np.round(rng.uniform(0, 360, size), 4),
+        "DEC": np.round(np.rad2deg(np.arcsin(rng.uniform(-1, 1, size))), 4),
+    })
+    cat.to_csv(path, index=False)
+
+
+def measure(func, repeat, memory=True):
+    ''' (result, minimum wall time [s], peak traced memory [MB]) of `func()`.
+    '''
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - t0)
+    peak = np.nan
+    if memory:
+        tracemalloc.start()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]/1024**2
+        tracemalloc.stop()
+    return result, np.min(times), peak
+
+
+def bench_size(size, durations, tmpdir, repeat, memory, max_exact, plot):
+    ''' Run all the stages for a catalog of `size` objects; returns the results as dicts.
+    '''
+    csvpath = Path(tmpdir)/f"cat{size}.csv"
+    make_catalog(size, csvpath)
+    cache_dir = Path(tmpdir)/"cache"
+    loc = EarthLocation.from_geodetic(LOCATION[0]*u.deg, LOCATION[1]*u.deg, 500*u.m)
+    obs = ap.Observer(location=loc, timezone="Asia/Seoul")
+
+    def run(ntimes, stage, func):
+        result, dt, peak = measure(func, repeat, memory)
+        print(f"{size:>7d} {ntimes:>6} {stage:<24s} {dt:9.4f} {peak:9.1f}", flush=True)
+        results.append(dict(size=size, ntimes=ntimes, stage=stage, time=dt, peak_mb=peak))
+        return result
+
+    results = []
+    run("-", "load catalog (csv)", lambda: ft.load_catalog(csvpath, columns=ft.CATCOLS))
+    ft.load_catalog(csvpath, columns=ft.CATCOLS, cache_dir=cache_dir)  # compile once
+    cat = run("-", "load catalog (compiled)",
+              lambda: ft.load_catalog(csvpath, columns=ft.CATCOLS, cache_dir=cache_dir))
+    index = run("-", "build index", lambda: ft.build_index(cat))
+
+    for duration in durations:
+        _, alltimes = ft.time_grid(OBSTIME, duration)
+        ntimes = len(alltimes) - 3
+        lst = alltimes[[0, 2]].sidereal_time("mean", longitude=loc.lon).deg
+        labels = run(ntimes, "pre-filter", lambda: ft.query_index(index, LOCATION[1], 30, lst=lst))
+        _cat = cat[cat.index.isin(labels)].sort_values(by="DEC", ascending=False,
+                                                        ignore_index=True)
+        coo = run(ntimes, "targets (SkyCoord)",
+                  lambda: SkyCoord(ra=_cat["RA"].values*u.deg, dec=_cat["DEC"].values*u.deg))
+        ft.load_transform_cache(loc, alltimes, cache_dir, planets=True)  # build the files once
+        rot, xyz_pl = run(ntimes, "transform cache",
+                          lambda: ft.load_transform_cache(loc, alltimes, cache_dir, planets=True))
+        alt, _ = run(ntimes, "altaz (cached)", lambda: ft.altaz_matrix(obs, coo, alltimes, rot=rot))
+        if len(coo) <= max_exact:
+            run(ntimes, "altaz (exact)", lambda: ft.altaz_matrix(obs, coo, alltimes))
+        upmask = run(ntimes, "check_observable",
+                     lambda: ft.check_observable(30, alt[:, 3:], False))
+        run(ntimes, "altitude range", lambda: ft.check_observable_range(30, *ft.altitude_range(
+            *ft.hadec_from_altaz(np.einsum("ij,nj->ni", rot[1], coo.cartesian.xyz.value.T),
+                                 LOCATION[1]),
+            LOCATION[1], duration
+        ), False))
+        run(ntimes, "planets (get_body)", lambda: ft.altaz_matrix(
+            obs, SkyCoord([get_body(planet, time=OBSTIME, location=loc) for planet in ft.PLANETS]),
+            alltimes[3:]
+        ))
+        run(ntimes, "planets (cached)", lambda: ft.xyz2alt(xyz_pl[:, 3:]))
+        moon = run(ntimes, "moon track", lambda: ft.moon_track(obs, alltimes))
+        run(ntimes, "scores", lambda: ft.score_targets(_cat, alt, moon, 30))
+
+        cat_up = _cat[upmask].reset_index(drop=True)
+        run(ntimes, "schedule", lambda: ft.schedule_night(cat_up, obs, OBSTIME, duration, 30,
+                                                          cache_dir=cache_dir))
+        colnames = ft.alt_colnames(OBSTIME.datetime, duration)
+        for fmt in ["html", "csv"]:
+            outpath = Path(tmpdir)/f"out.{fmt}"
+            run(ntimes, f"report ({fmt})", lambda: ft.save_table(
+                ft.make_table(cat_up, alt[upmask, :3], fmt=fmt, colnames=colnames), outpath, fmt
+            ))
+        if plot:
+            run(ntimes, "plot", lambda: plot_altitudes(alt[upmask, 3:], alltimes[3:],
+                                                       Path(tmpdir)/"plot.png"))
+    return results
+
+
+def plot_altitudes(alt, times, path):
+    ''' The altitude curves (one style) and twilight shading as in `find_targets.py`.
+    '''
+    plt = ft.setup_plot()
+    fig, ax = plt.subplots(1, 1, figsize=(9, 9))
+    x = times.plot_date
+    ft.plot_curves(ax, x, alt, 30, plt.cm.viridis(np.linspace(0, 1, len(alt))),
+                   [""]*len(alt), ls="-", lw=2, alpha=0.7)
+    ft.plot_twilight(ax, x, np.linspace(10, -20, len(x)))
+    ft.format_altitude_axes(ax, x, 30)
+    fig.savefig(path)
+    plt.close(fig)
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("-n", "--sizes", default=[200, 10000, 100000], type=int, nargs='+',
+                   help="Numbers of objects of the synthetic catalogs")
+    p.add_argument("-d", "--durations", default=[0.5, 2, 6], type=float, nargs='+',
+                   help="Durations (+- this number) [hour], setting the length of the time grid")
+    p.add_argument("-r", "--repeat", default=3, type=int, help="Number of runs per stage")
+    p.add_argument("--no-memory", action="store_true",
+                   help="Do not measure the peak memory (tracemalloc)")
+    p.add_argument("--max-exact", default=10000, type=int,
+                   help="Run the exact (uncached) altaz only for at most this many targets")
+    p.add_argument("-P", "--no-plot", action="store_true", help="Skip the plotting stage")
+    p.add_argument("-o", "--output", default=None, help="Also save the results as JSON")
+    args = p.parse_args()
+
+    import matplotlib
+    matplotlib.use("Agg")
+
+    results = []
+    print(f"{'size':>7s} {'ntimes':>6s} {'stage':<24s} {'time [s]':>9s} {'peak [MB]':>9s}")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for size in args.sizes:
+            results += bench_size(size, args.durations, tmpdir, args.repeat,
+                                  memory=not args.no_memory, max_exact=args.max_exact,
+                                  plot=not args.no_plot)
+    if args.output is not None:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=1)
@@ -0,0 +1,62 @@
+''' Wall time of fresh `find_targets.py` processes (import and startup cost).
+
+Each case is run in a new Python process `--repeat` times, and the minimum and median
+wall times are printed. Use it to compare the headless path (`-P`) with the plotting path,
+e.g., on the kiosk:
+
+    $ python benchmarks/bench_startup.py --repeat 5
+'''
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+TOP = Path(__file__).resolve().parent.parent
+SCRIPT = str(TOP/"find_targets.py")
+DATE = ["2021", "11", "12", "20", "30", "00"]
+
+
+def timeit_process(cmd, repeat, env=None):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        subprocess.run(cmd, check=True, env=env, cwd=TOP,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - t0)
+    return np.min(times), np.median(times)
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("-r", "--repeat", default=3, type=int, help="Number of runs per case")
+    args = p.parse_args()
+
+    env = dict(os.environ, MPLBACKEND="Agg")  # plt.show() must not block.
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cases = {
+            "python (baseline)": [sys.executable, "-c", "pass"],
+            "import matplotlib.pyplot": [sys.executable, "-c", "import matplotlib.pyplot"],
+            "import astroplan.plots": [sys.executable, "-c", "import astroplan.plots"],
+            "import rich": [sys.executable, "-c", "import rich.traceback"],
+            "import find_targets": [sys.executable, "-c", "import find_targets"],
+            "run -P (csv)": [sys.executable, SCRIPT, *DATE, "-P", "-o", f"{tmpdir}/out.csv"],
+            "run -P (html)": [sys.executable, SCRIPT, *DATE, "-P", "-o", f"{tmpdir}/out.html"],
+            "run with plot": [sys.executable, SCRIPT, *DATE, "-o", f"{tmpdir}/out.html"],
+        }
+        # Fill the caches (transforms, compiled catalog) so that only the startup is timed.
+        subprocess.run(cases["run -P (csv)"], check=True, env=env, cwd=TOP,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        print(f"{'case':<26s} {'min [s]':>8s} {'median [s]':>11s}")
+        for name, cmd in cases.items():
+            try:
+                tmin, tmed = timeit_process(cmd, args.repeat, env=env)
+            except subprocess.CalledProcessError:
+                print(f"{name:<26s} {'failed':>8s}")
+                continue
+            print(f"{name:<26s} {tmin:8.3f} {tmed:11.3f}")
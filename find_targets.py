@@ -1,41 +1,29 @@
 # %%
 import argparse
+import contextlib
 import datetime
+import io
+import json
+import os
+import shutil
+import sys
+import time
 from pathlib import Path
 
+_T0 = time.perf_counter()  # Origin of the `--profile` trace (before the heavy imports)
+
 import astroplan as ap
 import astropy.units as u
 import numpy as np
 import pandas as pd
 import pytz
-from astroplan import plots as aplt
-from astropy.coordinates import EarthLocation, get_body, SkyCoord
+from astropy.coordinates import AltAz, EarthLocation, get_body, SkyCoord
 from astropy.time import Time
-from matplotlib import pyplot as plt
-from matplotlib import rcParams
 import warnings
 warnings.filterwarnings('ignore', append=True)
 
-try:
-    from rich import print
-    from rich.traceback import install
-    install()
-except ImportError:
-    print("You may want to install `rich` by $ pip install rich")
-    pass
-
-
-plt.style.use('default')
-rcParams.update({
-    'font.family': 'Times', 'font.size': 12, 'mathtext.fontset': 'stix',
-    'axes.formatter.use_mathtext': True, 'axes.formatter.limits': (-4, 4),
-    'axes.grid': True, 'grid.color': 'gray', 'grid.linewidth': 0.5,
-    'xtick.top': True, 'ytick.right': True,
-    'xtick.direction': 'inout', 'ytick.direction': 'inout',
-    'xtick.minor.size': 4.0, 'ytick.minor.size': 4.0,  # default 2.0
-    'xtick.major.size': 8.0, 'ytick.major.size': 8.0,  # default 3.5
-    'xtick.minor.visible': True, 'ytick.minor.visible': True
-})
+# NOTE: matplotlib and rich are imported only when they are used (see
+#   `setup_plot` and the main block), as they dominate the startup time of headless runs.
 
 PLANETS = {
     'Mercury': "gray",
@@ -47,6 +35,64 @@ PLANETS = {
     'Neptune': "blue"
 }
 
+# Earth-orientation/ephemeris transforms are cached on disk per site and per UT day, sampled
+# every 1/CACHE_NSTEP day, and linearly interpolated to the requested times. The rotation
+# matrices and the planets are cached in separate files: the planets (most of the cost) are
+# computed only when they are used (for the plot and the frames).
+CACHE_NSTEP = 1440  # once per minute
+CACHE_MAXSIZE = 50  # [MB] Oldest cache files are removed beyond this total size.
+CACHE_NMEMORY = 8  # Number of cache files kept in memory (for long-running processes)
+_CACHE_MEMORY = {}
+
+# Margin of the index pre-filter (`query_index`) [deg]. Covers the precession since J2000
+# and the approximations of the transform cache, so no observable object is discarded.
+PREFILTER_MARGIN = 1.
+
+# Rate of the hour angle of fixed targets [deg/hour] (one sidereal day per 360 deg).
+SIDEREAL_RATE = 360.98564736629/24
+
+# Scores (`--rank`, `--min-score`): V-band sky brightness from a moonless sky of DARK_SKY_MAG
+# at the zenith plus the moonlight (Krisciunas & Schaefer 1991, PASP 103, 1033), and the
+# extinction of EXTINCTION_K.
+DARK_SKY_MAG = 21.6  # [mag/arcsec2]
+EXTINCTION_K = 0.2  # [mag/airmass]
+
+# Observing sequence (`--schedule`): time on each target, slew rate (per axis of an equatorial
+# mount) and settling time, and the cost of slewing in the choice of the next target.
+SCHEDULE_DWELL = 10.  # [min]
+SLEW_RATE = 2.  # [deg/s]
+SLEW_SETTLE = 10.  # [s]
+SLEW_COST = 1.  # [deg of altitude per minute of slew]
+
+# Frames (`--snapshots`, `--animate`): the sky every FRAME_STEP minutes within the time ±
+# duration, computed FRAME_CHUNK frames at a time so that the memory does not grow with the
+# number of frames.
+FRAME_STEP = 5.  # [min]
+FRAME_CHUNK = 64
+FRAME_FPS = 10
+
+# Time grid of the multi-night planner (`--nights`): from local noon to the next noon.
+NIGHT_NSTEP = 288  # once per 5 minutes
+
+# Current location (`--currentlocation`): the answer of GEOIP_URL is reused for LOCATION_TTL
+# hours; a lookup taking longer than LOCATION_TIMEOUT seconds falls back to the last known one.
+GEOIP_URL = "http://ip-api.com/json/"
+LOCATION_TTL = 24.  # [hour]
+LOCATION_TIMEOUT = 3.  # [s]
+
+# Offline runs (`--bundle`, `--offline`): the IERS-A table, the leap seconds and the solar
+# system ephemeris are snapshotted in BUNDLE_DIR (in the cache directory) and loaded from
+# there, without any download attempt.
+BUNDLE_DIR = "bundle"
+JPL_KERNEL_URL = "https://naif.jpl.nasa.gov/pub/naif/generic_kernels/spk/planets/{}.bsp"
+
+# Timing spans (name, start, end) [s] recorded by `span` if _PROFILE (`--profile`) is set.
+_SPANS = [("imports", _T0, None)]
+_PROFILE = False
+
+# Catalog columns used by this script; others (e.g., "Distance (kly)") are not loaded.
+CATCOLS = ["ID", "Other ID", "Name", "Type", "Mag", "RA", "DEC"]
+
 COLS2DROP = ["Other ID", "Distance (kly)", "Constellation", "RA", "DEC"]
 
 PLOTKW = {
@@ -116,6 +162,12 @@ p.add_argument("-E", "--type-exclude", action="store_true",
 p.add_argument("-c", "--currentlocation", action="store_true",
                help=("Use current location and timezone automatically "
                      + "(using http://ip-api.com/json/)"))
+p.add_argument("--geoip-url", default=GEOIP_URL,
+               help="URL answering the location as ip-api.com does (e.g., a local stand-in)")
+p.add_argument("--location-ttl", default=LOCATION_TTL, type=float,
+               help="Hours to reuse the saved current location without looking it up again")
+p.add_argument("--location-timeout", default=LOCATION_TIMEOUT, type=float,
+               help="Seconds to wait for the current location before using the last known one")
 p.add_argument("-v", "--verbose", action="store_true",
                help="Print miscellaneous information")
 
@@ -134,49 +186,1492 @@ p.add_argument("-T", "--types", default=None, nargs='+',
                help="Target types to be drawn or excluded (exclusion by -E)")
 p.add_argument("-t", "--targets", nargs='+', default=None,
                help="Target names to be drawn")
-p.add_argument("-o", "--output", default=None, help="HTML name to save DataFrame")
+p.add_argument("-o", "--output", default=None,
+               help="File name to save DataFrame (default: output.<format>)")
+p.add_argument("-f", "--format", default=None, choices=["html", "csv", "json"],
+               help="Format of the output table (default: from the extension of -o, or html)")
+p.add_argument("-P", "--no-plot", action="store_true",
+               help="Do not plot (matplotlib is then not even imported)")
+p.add_argument("-n", "--nights", default=None, type=int,
+               help=("Plan N nights from the given date: rise/transit/set, hours above --min-alt"
+                     + " and the best window of each object, saved as one table (no plot)"))
+p.add_argument("-s", "--max-sun-alt", default=-12., type=float,
+               help="Maximum altitude of the Sun to be regarded as night (for --nights) [deg]")
+p.add_argument("-R", "--rank", action="store_true",
+               help=("Sort the table by the score now (see `score_targets`: brightness of the "
+                     + "object over the sky, with the Moon and the airmass), not by Type"))
+p.add_argument("--min-score", default=None, type=float,
+               help="Only the objects with the score now above this (implies the score columns)")
+p.add_argument("--sky-mag", default=DARK_SKY_MAG, type=float,
+               help="V sky brightness at the zenith without the Moon [mag/arcsec2], for the score")
+p.add_argument("--schedule", action="store_true",
+               help=("Save the observing sequence within the time ± duration (see "
+                     + "`schedule_night`) instead of the table of visible objects (no plot)"))
+p.add_argument("--dwell", default=SCHEDULE_DWELL, type=float,
+               help="Time on each object of --schedule [min]")
+p.add_argument("--slew-rate", default=SLEW_RATE, type=float,
+               help="Slew rate of the mount per RA/DEC axis for --schedule [deg/s]")
+p.add_argument("--settle", default=SLEW_SETTLE, type=float,
+               help="Settling time after each slew for --schedule [s]")
+p.add_argument("--slew-cost", default=SLEW_COST, type=float,
+               help=("Cost of one minute of slew, as degrees below the best altitude, in the "
+                     + "choice of the next object of --schedule"))
+p.add_argument("--snapshots", default=None, metavar="PATH",
+               help=("Write the positions (alt, az) of the visible objects, planets, Moon and "
+                     + "Sun every --frame-step within the time ± duration as JSON lines to PATH "
+                     + "(a file, or a named pipe for a live display), one line per frame"))
+p.add_argument("--animate", default=None, metavar="PATH",
+               help=("Save the same frames as an alt-az sky map: a movie if PATH has a suffix "
+                     + "(.gif, or .mp4 etc. by ffmpeg), otherwise PNG files in the directory"))
+p.add_argument("--frame-step", default=FRAME_STEP, type=float,
+               help="Time between the frames of --snapshots and --animate [min]")
+p.add_argument("-I", "--self-contained", action="store_true",
+               help=("Embed the images of the visible objects in the HTML table, from the sprite "
+                     + "sheets of onetime_downloader.py (figs/sprites/), so that it is one file"))
+p.add_argument("-L", "--sites", default=None,
+               help=("CSV file of many sites (columns: name, lon, lat[, height]), evaluated at "
+                     + "once for the same instants; saves one combined table (no plot)"))
+p.add_argument("-S", "--serve", default=None, type=int, metavar="PORT",
+               help=("Run as an HTTP server at PORT answering `/up?<query>` (see `serve`), "
+                     + "with the options given here as the defaults of the queries"))
+p.add_argument("--host", default="127.0.0.1", help="Host name/address for --serve")
+p.add_argument("--cache-dir", default=None,
+               help="Directory of the transform cache (default: `.cache/` next to this file)")
+p.add_argument("--profile", default=None, metavar="TRACE.json",
+               help=("Save the wall time of each stage (geolocation, catalog, transforms, table,"
+                     + " plot, ...) as a JSON trace (Chrome trace event format)"))
+p.add_argument("--cprofile", default=None, metavar="PROFILE.pstats",
+               help="Also run cProfile and dump the statistics (for pstats or snakeviz)")
+p.add_argument("--bundle", action="store_true",
+               help=("Save the IERS-A table, the leap seconds and the ephemeris (--ephemeris) "
+                     + "in the cache directory for --offline, and exit"))
+p.add_argument("--ephemeris", default="builtin",
+               help=("Solar system ephemeris saved by --bundle: 'builtin' (analytic, no file) or"
+                     + " a JPL kernel name (e.g., de440s, needs jplephem) or URL"))
+p.add_argument("--offline", action="store_true",
+               help=("Never access the network: the IERS tables and the ephemeris are loaded "
+                     + "from the bundle (see --bundle), and -c uses the last known location"))
+p.add_argument("--no-cache", action="store_true",
+               help=("Do not use the caches: transforms are exact (but slower) and the catalog"
+                     + " is read from the CSV file"))
+
+
+@contextlib.contextmanager
+def span(name):
+    ''' Record the wall time of the block as a span of the `--profile` trace (nothing is
+    recorded without `--profile`, e.g., for each request of `--serve`).
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if _PROFILE:
+            _SPANS.append((name, start, time.perf_counter()))
+
+
+def save_trace(path, verbose=False):
+    ''' Save the spans in the Chrome trace event format (open it by chrome://tracing or
+    https://ui.perfetto.dev; nested spans are shown nested) and print a summary.
+    '''
+    events = [dict(name=name, ph="X", pid=os.getpid(), tid=0,
+                   ts=round((start - _T0)*1e6), dur=round((end - start)*1e6))
+              for name, start, end in _SPANS]
+    with open(path, "w") as trace:
+        json.dump(dict(traceEvents=events, displayTimeUnit="ms"), trace, indent=1)
+    if verbose:
+        for name, start, end in sorted(_SPANS, key=lambda sp: sp[1]):
+            print(f"{start - _T0:8.3f} s  {end - start:8.3f} s  {name}")
+        print(f"* Trace saved to {path}")
+
+
+def altaz_matrix(observer, coords, times, rot=None):
+    ''' Altitude and airmass of all targets at all times by a single transform.
+
+    Parameters
+    ----------
+    observer : astroplan.Observer
+        The observer (only its location is used).
+    coords : SkyCoord
+        1-D array of target coordinates, shape ``(n_targets,)``.
+    times : Time
+        1-D array of times, shape ``(n_times,)``.
+    rot : ndarray, optional
+        ICRS to AltAz rotation matrices of shape ``(n_times, 3, 3)`` from
+        `load_transform_cache`. If given, they are used instead of the full
+        astropy transformation.
+
+    Returns
+    -------
+    alt, airmass : ndarray
+        Altitude [deg] and airmass (sec z), both of shape ``(n_targets, n_times)``.
+    '''
+    if rot is not None:
+        xyz = coords.icrs.cartesian.xyz.value.T  # unit vectors, (n_targets, 3)
+        return xyz2alt(np.einsum("tij,nj->nti", rot, xyz))
+    frame = AltAz(obstime=times, location=observer.location)
+    altaz = coords[:, np.newaxis].transform_to(frame)
+    return altaz.alt.to_value(u.deg), altaz.secz.value
+
+
+def xyz2alt(xyz):
+    ''' Altitude [deg] and airmass from AltAz cartesian vectors (last axis is x, y, z).
+    '''
+    sinalt = xyz[..., 2]/np.linalg.norm(xyz, axis=-1)
+    return np.rad2deg(np.arcsin(sinalt)), 1/sinalt
+
+
+def hadec_from_altaz(xyz, lat):
+    ''' Hour angle and declination [deg] from AltAz cartesian vectors (last axis: x to the
+    North, y to the East, z to the zenith) at latitude `lat` [deg] (broadcast).
+    '''
+    x, y, z = np.moveaxis(xyz/np.linalg.norm(xyz, axis=-1, keepdims=True), -1, 0)
+    sinlat, coslat = np.sin(np.deg2rad(lat)), np.cos(np.deg2rad(lat))
+    dec = np.arcsin(np.clip(sinlat*z + coslat*x, -1, 1))
+    ha = np.arctan2(-y, coslat*z - sinlat*x)
+    return np.rad2deg(ha), np.rad2deg(dec)
+
+
+def target_hadec(coords, loc, obstime, rot=None):
+    ''' Hour angles and declinations [deg] of fixed targets at `obstime` (for `altitude_at`)
+    from one transformation, or from the cached ICRS to AltAz rotation `rot` at `obstime`
+    (shape ``(3, 3)``; see `load_transform_cache`).
+    '''
+    if rot is None:
+        xyz = coords.transform_to(AltAz(obstime=obstime, location=loc)).cartesian.xyz.value.T
+    else:
+        xyz = np.einsum("ij,nj->ni", rot, coords.icrs.cartesian.xyz.value.T)
+    return hadec_from_altaz(xyz, loc.lat.deg)
+
+
+def altitude_at(ha, dec, lat, dhours):
+    ''' Altitude [deg] of fixed targets `dhours` [hour] after their hour angle was `ha`.
+
+    Parameters
+    ----------
+    ha, dec : ndarray
+        Hour angle and declination [deg] (from `hadec_from_altaz`), shape ``(..., n_targets)``.
+    lat : float or ndarray
+        Latitude [deg], broadcast with `ha`.
+    dhours : array-like
+        Time offsets [hour], shape ``(n_times,)`` (or per target, ``(..., n_targets, n_times)``).
+
+    Returns
+    -------
+    alt : ndarray
+        Shape ``(..., n_targets, n_times)``.
+    '''
+    ha = np.deg2rad(ha[..., np.newaxis] + SIDEREAL_RATE*np.asarray(dhours, dtype=float))
+    dec, lat = np.deg2rad(dec[..., np.newaxis]), np.deg2rad(np.asarray(lat)[..., np.newaxis])
+    sinalt = np.sin(lat)*np.sin(dec) + np.cos(lat)*np.cos(dec)*np.cos(ha)
+    return np.rad2deg(np.arcsin(np.clip(sinalt, -1, 1)))
+
+
+def altaz_at(ha, dec, lat, dhours):
+    ''' Altitudes and azimuths [deg] (from the North to the East) of fixed targets, with the
+    arguments and shapes of `altitude_at`.
+    '''
+    ha = np.deg2rad(ha[..., np.newaxis] + SIDEREAL_RATE*np.asarray(dhours, dtype=float))
+    dec, lat = np.deg2rad(dec[..., np.newaxis]), np.deg2rad(np.asarray(lat)[..., np.newaxis])
+    x = np.cos(lat)*np.sin(dec) - np.sin(lat)*np.cos(dec)*np.cos(ha)
+    y = -np.cos(dec)*np.sin(ha)
+    z = np.sin(lat)*np.sin(dec) + np.cos(lat)*np.cos(dec)*np.cos(ha)
+    return np.rad2deg(np.arcsin(np.clip(z, -1, 1))), np.rad2deg(np.arctan2(y, x)) % 360
+
+
+def altitude_range(ha, dec, lat, duration):
+    ''' Exact minimum and maximum altitudes [deg] of fixed targets within ± `duration` [hour]
+    from the hour angle `ha` (arguments as in `altitude_at`).
+
+    The altitude only depends on |hour angle|: the maximum is at the upper culmination
+    (hour angle 0) if it is within the window, otherwise at one of its ends; likewise the
+    minimum with the lower culmination (hour angle 180).
+    '''
+    half = SIDEREAL_RATE*duration
+    alt_ends = altitude_at(ha, dec, lat, [-duration, duration])
+    alt_cul = altitude_at(np.zeros_like(ha), dec, lat, [0, 180/SIDEREAL_RATE])
+    # Whether the culminations (hour angle 0, 180) are within [ha - half, ha + half]
+    has_upper = np.abs((ha + 180) % 360 - 180) <= half
+    has_lower = np.abs(ha % 360 - 180) <= half
+    alt_min = np.where(has_lower, alt_cul[..., 1], alt_ends.min(axis=-1))
+    alt_max = np.where(has_upper, alt_cul[..., 0], alt_ends.max(axis=-1))
+    return alt_min, alt_max
+
+
+def airmass(alt):
+    ''' Airmass at altitude `alt` [deg] (Krisciunas & Schaefer 1991, eq. 3; NaN below the
+    horizon).
+    '''
+    alt = np.asarray(alt, dtype=float)
+    with np.errstate(invalid="ignore"):
+        return np.where(alt > 0, 1/np.sqrt(1 - 0.96*np.cos(np.deg2rad(alt))**2), np.nan)
 
-args = p.parse_args()
 
+def _mag2nl(mag):
+    return 34.08*np.exp(20.7233 - 0.92104*mag)  # [mag/arcsec2] -> [nanoLambert]
 
-def check_observable(min_alt, observer, targets, times, always):
-    consts = [ap.AltitudeConstraint(min_alt*u.deg)]
+
+def _nl2mag(nl):
+    return (20.7233 - np.log(nl/34.08))/0.92104
+
+
+def moon_track(observer, times):
+    ''' Topocentric unit vectors (ICRS axes, shape ``(n_times, 3)``), altitudes [deg] and
+    phase angles [deg] (0 at full moon) of the Moon at `times`.
+    '''
+    moon = get_body("moon", times, location=observer.location)
+    xyz = moon.cartesian.xyz.value.T
+    alt = moon.transform_to(AltAz(obstime=times, location=observer.location)).alt.deg
+    phase = observer.moon_phase(times).to_value(u.deg)
+    return xyz/np.linalg.norm(xyz, axis=-1, keepdims=True), alt, phase
+
+
+def sky_brightness(alt, sep, moon_alt, moon_phase, dark=DARK_SKY_MAG, k=EXTINCTION_K):
+    ''' V sky brightness [mag/arcsec2] towards the targets (Krisciunas & Schaefer 1991).
+
+    Parameters
+    ----------
+    alt, sep : ndarray
+        Altitudes of and separations from the Moon of the targets [deg], shape
+        ``(n_targets, n_times)``.
+    moon_alt, moon_phase : ndarray
+        Altitudes and phase angles of the Moon [deg], shape ``(n_times,)``.
+    dark : float
+        Sky brightness at the zenith without the Moon [mag/arcsec2].
+    k : float
+        Extinction coefficient [mag/airmass].
+    '''
+    X = airmass(alt)
+    b_dark = _mag2nl(dark)*10**(-0.4*k*(X - 1))*X
+    istar = 10**(-0.4*(3.84 + 0.026*np.abs(moon_phase) + 4e-9*moon_phase**4))
+    scatter = 10**5.36*(1.06 + np.cos(np.deg2rad(sep))**2) + 10**(6.15 - sep/40)
+    b_moon = scatter*istar*10**(-0.4*k*airmass(np.maximum(moon_alt, 0.1)))*(1 - 10**(-0.4*k*X))
+    return _nl2mag(b_dark + np.where(moon_alt > 0, b_moon, 0))
+
+
+def score_targets(cat, alt, moon, min_alt, now=1, dark=DARK_SKY_MAG, k=EXTINCTION_K):
+    ''' Scores of the targets over the time grid: how much brighter the object (`Mag`,
+    dimmed by the extinction) is than the sky around it (`sky_brightness`) [mag]. NaN
+    where the object is below `min_alt` (or without `Mag`).
+
+    Parameters
+    ----------
+    cat : DataFrame
+        Targets with ``RA``, ``DEC`` [deg] and ``Mag``.
+    alt : ndarray
+        Altitudes of the targets [deg], shape ``(n_targets, n_times)``.
+    moon : tuple
+        The Moon at the same times, from `moon_track`.
+    now : int
+        Index of the time of the "now" columns.
+
+    Returns
+    -------
+    table : DataFrame
+        The ``Moon sep`` [deg], ``Sky`` [mag/arcsec2] and ``Score`` at `now`, with the index
+        of `cat`.
+    score : ndarray
+        The scores at all times, shape ``(n_targets, n_times)``.
+    '''
+    moon_xyz, moon_alt, moon_phase = moon
+    ra = np.deg2rad(cat["RA"].to_numpy(dtype=float))
+    dec = np.deg2rad(cat["DEC"].to_numpy(dtype=float))
+    xyz = np.stack([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)], axis=-1)
+    sep = np.rad2deg(np.arccos(np.clip(xyz @ moon_xyz.T, -1, 1)))
+    sky = sky_brightness(alt, sep, moon_alt, moon_phase, dark=dark, k=k)
+    mag = pd.to_numeric(cat["Mag"], errors="coerce").to_numpy(dtype=float)
+    score = np.where(alt >= min_alt, sky - (mag[:, np.newaxis] + k*airmass(alt)), np.nan)
+    table = pd.DataFrame({"Moon sep": np.round(sep[:, now], 1), "Sky": np.round(sky[:, now], 2),
+                          "Score": np.round(score[:, now], 2)}, index=cat.index)
+    return table, score
+
+
+def _cache_path(cache_dir, loc, mjd, kind="altaz"):
+    lon, lat, height = loc.lon.deg, loc.lat.deg, loc.height.to_value(u.m)
+    return Path(cache_dir)/f"{kind}_{lon:+09.4f}_{lat:+08.4f}_{height:.0f}m_{mjd:d}.npz"
+
+
+def _build_cache_block(loc, mjd, kind="altaz"):
+    ''' The ICRS -> AltAz rotation matrices (`kind` "altaz") or the AltAz unit vectors of
+    `PLANETS` (`kind` "planets") for a UT day (MJD `mjd`), sampled at ``CACHE_NSTEP + 1``
+    times (both ends included).
+
+    The matrices are the transformed ICRS basis vectors, so aberration is treated as a
+    rotation: the resulting altitudes agree with the full transformation to < 1 arcmin.
+    '''
+    times = Time(mjd + np.arange(CACHE_NSTEP + 1)/CACHE_NSTEP, format="mjd", scale="utc")
+    frame = AltAz(obstime=times, location=loc)
+    if kind == "altaz":
+        basis = SkyCoord(x=[1, 0, 0], y=[0, 1, 0], z=[0, 0, 1], frame="icrs",
+                         representation_type="cartesian")
+        # (xyz, basis, time) -> (time, xyz, basis)
+        rot = np.moveaxis(basis[:, np.newaxis].transform_to(frame).cartesian.xyz.value, -1, 0)
+        return dict(rot=rot)
+    planets = []
+    for planet in PLANETS:
+        _xyz = get_body(planet, time=times, location=loc).transform_to(frame).cartesian.xyz.value
+        planets.append((_xyz/np.linalg.norm(_xyz, axis=0)).T)
+    return dict(planets=np.array(planets), names=np.array(list(PLANETS)))
+
+
+def _evict_cache(cache_dir, maxsize):
+    ''' Remove the least recently used cache files until the total is below `maxsize` [MB].
+    '''
+    files = [*Path(cache_dir).glob("altaz_*.npz"), *Path(cache_dir).glob("planets_*.npz")]
+    files = sorted(files, key=lambda f: f.stat().st_mtime)
+    total = sum(f.stat().st_size for f in files)
+    for fpath in files[:-1]:  # Never remove the most recent one.
+        if total <= maxsize*1024**2:
+            break
+        total -= fpath.stat().st_size
+        fpath.unlink(missing_ok=True)
+
+
+def _load_cache_block(loc, mjd, cache_dir, maxsize, kind="altaz"):
+    fpath = _cache_path(cache_dir, loc, mjd, kind)
+    if fpath in _CACHE_MEMORY:
+        return _CACHE_MEMORY[fpath]
+    block = _read_cache_block(loc, mjd, fpath, cache_dir, maxsize, kind)
+    _CACHE_MEMORY[fpath] = block
+    if len(_CACHE_MEMORY) > CACHE_NMEMORY:
+        _CACHE_MEMORY.pop(next(iter(_CACHE_MEMORY)))
+    return block
+
+
+def _read_cache_block(loc, mjd, fpath, cache_dir, maxsize, kind="altaz"):
+    if fpath.exists():
+        try:
+            with np.load(fpath) as npz:
+                block = dict(npz)
+            if kind == "altaz" or block["names"].tolist() == list(PLANETS):
+                block["rot" if kind == "altaz" else "planets"]  # KeyError if not there
+                os.utime(fpath)  # Mark as recently used for the eviction
+                return block
+        except (OSError, ValueError, KeyError):  # corrupted file: just rebuild it
+            pass
+
+    block = _build_cache_block(loc, mjd, kind)
+    fpath.parent.mkdir(parents=True, exist_ok=True)
+    # Write then rename, so that concurrent runs never read a partial file.
+    tmppath = fpath.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmppath, "wb") as tmp:
+        np.savez(tmp, **block)
+    os.replace(tmppath, fpath)
+    _evict_cache(cache_dir, maxsize)
+    return block
+
+
+def load_transform_cache(loc, times, cache_dir, maxsize=CACHE_MAXSIZE, planets=False):
+    ''' The transforms at `times`, interpolated from the disk cache at `cache_dir`.
+
+    The cache is keyed by the location (lon, lat, height) and the UT day, so repeated runs
+    for the same site and night reuse it regardless of the exact time grid. Missing days
+    are computed and saved; those of the planets only if `planets`.
+
+    Returns
+    -------
+    rot : ndarray
+        ICRS to AltAz rotation matrices, shape ``(n_times, 3, 3)``; see `altaz_matrix`.
+    planets : ndarray or None
+        AltAz cartesian vectors of `PLANETS`, shape ``(n_planets, n_times, 3)``; see
+        `xyz2alt`. `None` unless `planets`.
+    '''
+    mjd = times.utc.mjd
+    days = np.floor(mjd).astype(int)
+    rot = np.empty((len(mjd), 3, 3))
+    xyz_pl = np.empty((len(PLANETS), len(mjd), 3)) if planets else None
+    for day in np.unique(days):
+        sel = days == day
+        frac = (mjd[sel] - day)*CACHE_NSTEP
+        idx = np.minimum(frac.astype(int), CACHE_NSTEP - 1)
+        wei = frac - idx
+        block = _load_cache_block(loc, day, cache_dir, maxsize)
+        rot[sel] = ((1 - wei)[:, None, None]*block["rot"][idx]
+                    + wei[:, None, None]*block["rot"][idx + 1])
+        if planets:
+            block = _load_cache_block(loc, day, cache_dir, maxsize, kind="planets")
+            xyz_pl[:, sel] = ((1 - wei)[:, None]*block["planets"][:, idx]
+                              + wei[:, None]*block["planets"][:, idx + 1])
+    return rot, xyz_pl
+
+
+def make_bundle(bundle_dir, ephemeris="builtin", timeout=60, verbose=False):
+    ''' Save the IERS-A table (from `iers.conf.iers_auto_url`), the leap seconds (from
+    `iers.conf.iers_leap_second_auto_url`) and the `ephemeris` (a JPL kernel name such as
+    "de440s" or URL; nothing to save for "builtin") in `bundle_dir`, for `load_bundle`.
+
+    The IERS-A table is also saved parsed, as one ``.npy`` file per column (as
+    `compile_catalog`), so that it is memory-mapped instead of parsed at every run.
+    Raises `OSError` if a file cannot be downloaded; the previous bundle is kept as is.
+    '''
+    from astropy.utils import iers
+    from astropy.utils.data import download_file
+
+    bundle_dir = Path(bundle_dir)
+    sources = dict(iers_a=iers.conf.iers_auto_url,
+                   leap_seconds=iers.conf.iers_leap_second_auto_url)
+    if ephemeris != "builtin":
+        sources["ephemeris"] = (ephemeris if "://" in ephemeris
+                                else JPL_KERNEL_URL.format(ephemeris.lower()))
+    tmpdir = bundle_dir.with_name(f"{bundle_dir.name}.{os.getpid()}.tmp")
+    tmpdir.mkdir(parents=True, exist_ok=True)
+    try:
+        files = {}
+        for key, url in sources.items():
+            files[key] = url.rstrip("/").rsplit("/", 1)[-1]
+            try:
+                fpath = download_file(url, cache=False, timeout=timeout)
+            except OSError as err:  # URLError, timeout, ...
+                raise OSError(f"could not download {url}: {err}") from err
+            shutil.move(fpath, tmpdir/files[key])
+            if verbose:
+                print(f"* {url} saved")
+
+        iers_a = iers.IERS_A.open(str(tmpdir/files["iers_a"]))
+        columns = []
+        for i, col in enumerate(iers_a.colnames):
+            unit = getattr(iers_a[col], "unit", None)
+            np.save(tmpdir/f"iers{i:02d}.npy",
+                    np.asarray(getattr(iers_a[col], "value", iers_a[col])))
+            columns.append([col, None if unit is None else unit.to_string()])
+        mjd = iers_a["MJD"].to_value(u.d)
+        with open(tmpdir/"meta.json", "w") as meta:
+            json.dump(dict(saved_at=Time.now().isot, sources=sources, files=files,
+                           ephemeris=ephemeris, iers_columns=columns,
+                           predictive_index=int(iers_a.meta["predictive_index"]),
+                           predictive_mjd=float(iers_a.meta["predictive_mjd"]),
+                           last_mjd=float(mjd[-1])), meta, indent=1)
+    except BaseException:  # no partial bundle left behind
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+    shutil.rmtree(bundle_dir, ignore_errors=True)
+    os.replace(tmpdir, bundle_dir)
+
+
+def load_bundle(bundle_dir, verbose=False):
+    ''' Use the IERS tables and the ephemeris saved in `bundle_dir` by `make_bundle`, and
+    disable all the downloads of astropy for the rest of the process.
+
+    Without a bundle, astropy's own (older) tables and the builtin ephemeris are used. Times
+    beyond the tables are computed with a degraded accuracy instead of failing.
+    Returns the metadata of the bundle (`None` if there is none).
+    '''
+    from astropy.coordinates import solar_system_ephemeris
+    from astropy.time import update_leap_seconds
+    from astropy.utils import iers
+    from astropy.utils.data import conf as data_conf
+
+    data_conf.allow_internet = False
+    iers.conf.auto_download = False
+    iers.conf.iers_degraded_accuracy = "warn"  # beyond the tables: extrapolate, do not fail
+    bundle_dir = Path(bundle_dir)
+    try:
+        with open(bundle_dir/"meta.json") as meta:
+            meta = json.load(meta)
+    except (OSError, ValueError):
+        print(f"No bundle in {bundle_dir} (see --bundle); astropy's own IERS tables are used.")
+        return None
+
+    columns = {}
+    for i, (col, unit) in enumerate(meta["iers_columns"]):
+        arr = np.load(bundle_dir/f"iers{i:02d}.npy", mmap_mode='r')
+        columns[col] = arr if unit is None else u.Quantity(arr, unit, copy=False)
+    iers_meta = dict(predictive_index=meta["predictive_index"],
+                     predictive_mjd=meta["predictive_mjd"],
+                     data_path=str(bundle_dir/meta["files"]["iers_a"]))
+    iers.earth_orientation_table.set(iers.IERS_A(columns, meta=iers_meta, copy=False))
+    update_leap_seconds([str(bundle_dir/meta["files"]["leap_seconds"])])
+    if "ephemeris" in meta["files"]:
+        solar_system_ephemeris.set(str(bundle_dir/meta["files"]["ephemeris"]))
+    if verbose:
+        last = Time(meta["last_mjd"], format="mjd").iso[:10]
+        print(f"IERS-A and ephemeris ({meta['ephemeris']}) of {meta['saved_at'][:10]} "
+              + f"(predictions until {last}) loaded from {bundle_dir}")
+    return meta
+
+
+def compile_catalog(csvpath, outdir):
+    ''' Save the catalog CSV as one ``.npy`` file per column in `outdir`, for `load_catalog`.
+
+    Numeric columns are saved as float, the others as fixed-width unicode strings (NaN as
+    an empty string).
+    '''
+    csvpath, outdir = Path(csvpath), Path(outdir)
+    cat = pd.read_csv(csvpath, delimiter=',', comment="#")
+    tmpdir = outdir.with_name(f"{outdir.name}.{os.getpid()}.tmp")
+    tmpdir.mkdir(parents=True, exist_ok=True)
+    for i, col in enumerate(cat.columns):
+        if pd.api.types.is_numeric_dtype(cat[col]):
+            arr = cat[col].to_numpy(dtype=float)
+        else:
+            arr = cat[col].fillna("").to_numpy(dtype=str)
+        np.save(tmpdir/f"col{i:02d}.npy", arr)
+    stat = csvpath.stat()
+    with open(tmpdir/"meta.json", "w") as meta:
+        json.dump(dict(source=str(csvpath.resolve()), stamp=[stat.st_size, stat.st_mtime_ns],
+                       columns=cat.columns.tolist()), meta)
+    shutil.rmtree(outdir, ignore_errors=True)
+    os.replace(tmpdir, outdir)
+
+
+def load_catalog(csvpath, columns=None, cache_dir=None):
+    ''' Load the catalog, only with `columns` (all if `None`).
+
+    If `cache_dir` is given, the columns are memory-mapped from the compiled copy of the
+    CSV in it, which is (re-)made by `compile_catalog` when missing or outdated. Otherwise
+    the CSV is parsed.
+    '''
+    csvpath = Path(csvpath)
+    if cache_dir is None:
+        cat = pd.read_csv(csvpath, delimiter=',', comment="#", usecols=columns)
+        return cat if columns is None else cat[columns]
+
+    outdir = Path(cache_dir)/csvpath.stem
+    stat = csvpath.stat()
+    try:
+        with open(outdir/"meta.json") as meta:
+            meta = json.load(meta)
+        if meta["stamp"] != [stat.st_size, stat.st_mtime_ns]:
+            raise ValueError
+    except (OSError, ValueError, KeyError):
+        compile_catalog(csvpath, outdir)
+        with open(outdir/"meta.json") as meta:
+            meta = json.load(meta)
+
+    cat = {}
+    for col in (meta["columns"] if columns is None else columns):
+        arr = np.load(outdir/f"col{meta['columns'].index(col):02d}.npy", mmap_mode='r')
+        cat[col] = arr if arr.dtype.kind == 'f' else pd.Series(arr).replace("", np.nan)
+    return pd.DataFrame(cat)
+
+
+def build_index(cat):
+    ''' Declination-sorted index of the catalog, for `query_index`.
+    '''
+    order = np.argsort(cat["DEC"].values, kind="stable")
+    dec = cat["DEC"].values[order]
+    decrad = np.deg2rad(dec)
+    return dict(labels=cat.index.values[order], dec=dec, ra=cat["RA"].values[order],
+                sindec=np.sin(decrad), cosdec=np.cos(decrad))
+
+
+def query_index(index, lat, min_alt, lst=None, margin=PREFILTER_MARGIN):
+    ''' Catalog index labels of the objects that can be above `min_alt` [deg].
+
+    Objects with ``|dec - lat| > 90 - min_alt`` are cut by a binary search on the sorted
+    declinations. If `lst` is given, the remaining ones are also cut by the hour angle:
+    the object must be above `min_alt` for some local sidereal time between
+    ``lst = (beg, end)`` [deg] (increasing, wrapped at 360). Both cuts are loosened by
+    `margin` [deg], i.e., the result is a superset of the actually observable objects.
+    '''
+    alt0 = min_alt - margin
+    i_beg = np.searchsorted(index["dec"], lat - (90 - alt0), side="left")
+    i_end = np.searchsorted(index["dec"], lat + (90 - alt0), side="right")
+    labels = index["labels"][i_beg:i_end]
+    if lst is None:
+        return labels
+
+    lst_beg, lst_end = lst
+    latrad = np.deg2rad(lat)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Hour angle at which the object crosses alt0
+        cos_ha0 = ((np.sin(np.deg2rad(alt0)) - np.sin(latrad)*index["sindec"][i_beg:i_end])
+                   / (np.cos(latrad)*index["cosdec"][i_beg:i_end]))
+    ha0 = np.rad2deg(np.arccos(np.clip(np.nan_to_num(cos_ha0), -1, 1))) + margin
+    width = (lst_end - lst_beg) % 360
+    return labels[(index["ra"][i_beg:i_end] - lst_beg + ha0) % 360 <= width + 2*ha0]
+
+
+def check_observable(min_alt, alt, always):
+    ''' Mask of targets above `min_alt` at any (or all, if `always`) of the times.
+    `alt` is the (..., n_targets, n_times) altitude array, e.g., from `altaz_matrix`
+    [deg]. For fixed targets, `check_observable_range` is exact.
+    '''
     # , ap.AtNightConstraint(max_solar_altitude=0*u.deg)
-    mask_fun = ap.is_always_observable if always else ap.is_observable
-    mask = mask_fun(
-        constraints=consts,
-        observer=observer,
-        targets=targets.tolist(),
-        times=times
-    )
-    # coo_up = []
-    # for _m, _t in zip(mask, targets):
-    #     if _m:
-    #         coo_up.append(_t)
-    return mask
-
-
-def get_geoloc(use_current_location, verbose):
-    ''' Find geological location information from ip-api.com (lon, lat, timezone).
+    mask_fun = np.all if always else np.any
+    return mask_fun(alt >= min_alt, axis=-1)
+
+
+def check_observable_range(min_alt, alt_min, alt_max, always):
+    ''' `check_observable` from the altitude range (from `altitude_range`) over the window.
     '''
-    if use_current_location:
-        # TODO: Save these as cache files
-        from requests import get
-        ip = get('https://api.ipify.org').content.decode('utf8')
-        response = get("http://ip-api.com/json/" + ip).json()
+    return (alt_min if always else alt_max) >= min_alt
+
+
+def plan_nights(cat, coo, observer, start, nights, min_alt, max_sun_alt):
+    ''' Observability of the targets for each night, from one dense grid per night (by the
+    exact transformation: the grid is coarse, so it is faster than building the cache).
+
+    Parameters
+    ----------
+    cat : DataFrame
+        The catalog of the targets (``ID``, ``Name``, ``Type`` and ``Mag`` are used).
+    coo : SkyCoord
+        Coordinates of the targets, in the same order as `cat`.
+    observer : astroplan.Observer
+        The observer (location and timezone are used).
+    start : datetime.date
+        Local date of the first night (evening).
+    nights : int
+        Number of nights.
+    min_alt, max_sun_alt : float
+        Minimum altitude of the targets and maximum altitude of the Sun during the night
+        [deg].
+
+    Returns
+    -------
+    table : DataFrame
+        One row per night and target that is above `min_alt` during that night. Rise, set
+        and transit are for the `min_alt` crossings and the highest point within the noon to
+        noon interval; ``Hours`` and ``Best`` are within the night only. ``Best`` is the
+        night-time interval above `min_alt` that contains the highest altitude. Times are in
+        the local timezone.
+    '''
+    loc, tz = observer.location, observer.timezone
+    idx = np.arange(NIGHT_NSTEP + 1)
+    hours_per_step = 24/NIGHT_NSTEP
+    tables = []
+    for k in range(nights):
+        date = start + datetime.timedelta(days=k)
+        noon = tz.localize(datetime.datetime.combine(date, datetime.time(12)))
+        times = Time(noon) + idx/NIGHT_NSTEP*u.day
+        alt, _ = altaz_matrix(observer, coo, times)
+        frame = AltAz(obstime=times, location=loc)
+        dark = get_body("sun", times, loc).transform_to(frame).alt.deg < max_sun_alt
+        hhmm = np.array([_t.strftime("%H:%M") for _t in times.to_datetime(timezone=tz)] + [""])
+
+        above = alt >= min_alt
+        ok = above & dark
+        hours = ok.sum(axis=1)*hours_per_step
+        rises = ~above[:, :-1] & above[:, 1:]
+        sets = above[:, :-1] & ~above[:, 1:]
+        # Index -1 (the empty string in `hhmm`) if there is no such event.
+        i_rise = np.where(rises.any(axis=1), rises.argmax(axis=1) + 1, -1)
+        i_set = np.where(sets.any(axis=1), sets.argmax(axis=1), -1)
+        i_transit = alt.argmax(axis=1)
+
+        i_best = np.where(ok, alt, -np.inf).argmax(axis=1)
+        before = ~ok & (idx <= i_best[:, None])
+        after = ~ok & (idx >= i_best[:, None])
+        i_beg = np.where(before.any(axis=1), NIGHT_NSTEP + 1 - before[:, ::-1].argmax(axis=1), 0)
+        i_end = np.where(after.any(axis=1), after.argmax(axis=1) - 1, NIGHT_NSTEP)
+
+        up = hours > 0
+        table = cat.loc[up, ["ID", "Name", "Type", "Mag"]].copy()
+        table.insert(0, "Night", date.isoformat())
+        table["Rise"] = hhmm[i_rise[up]]
+        table["Transit"] = hhmm[i_transit[up]]
+        table["Set"] = hhmm[i_set[up]]
+        table["Alt_transit"] = np.round(alt[up, i_transit[up]], 1)
+        table["Hours"] = np.round(hours[up], 2)
+        table["Best_from"] = hhmm[i_beg[up]]
+        table["Best_to"] = hhmm[i_end[up]]
+        table["Alt_best"] = np.round(alt[up, i_best[up]], 1)
+        tables.append(table)
+    return pd.concat(tables, ignore_index=True)
+
+
+def setup_plot():
+    ''' Import the plotting modules and set the plotting style.
+    '''
+    from matplotlib import pyplot as plt
+    from matplotlib import rcParams
+
+    plt.style.use('default')
+    rcParams.update({
+        'font.family': 'Times', 'font.size': 12, 'mathtext.fontset': 'stix',
+        'axes.formatter.use_mathtext': True, 'axes.formatter.limits': (-4, 4),
+        'axes.grid': True, 'grid.color': 'gray', 'grid.linewidth': 0.5,
+        'xtick.top': True, 'ytick.right': True,
+        'xtick.direction': 'inout', 'ytick.direction': 'inout',
+        'xtick.minor.size': 4.0, 'ytick.minor.size': 4.0,  # default 2.0
+        'xtick.major.size': 8.0, 'ytick.major.size': 8.0,  # default 3.5
+        'xtick.minor.visible': True, 'ytick.minor.visible': True
+    })
+    return plt
+
+
+def plot_curves(ax, x, alts, min_alt, colors, labels, ls="-", lw=2, alpha=1):
+    ''' Draw the altitude curves (rows of `alts`, masked below `min_alt`) of one style as a
+    single LineCollection. Returns the legend handles (one per curve, not drawn).
+    '''
+    from matplotlib.collections import LineCollection
+    from matplotlib.lines import Line2D
+
+    alts = np.where(np.asarray(alts) < min_alt, np.nan, alts)  # NaN breaks the lines.
+    segments = np.stack(np.broadcast_arrays(x[np.newaxis, :], alts), axis=-1)
+    ax.add_collection(LineCollection(segments, colors=colors, linestyles=ls, linewidths=lw,
+                                     alpha=alpha))
+    return [Line2D([], [], color=c, linestyle=ls, linewidth=lw, alpha=alpha, label=label)
+            for c, label in zip(colors, labels)]
+
+
+def plot_twilight(ax, x, sun_alt):
+    ''' Shade the background darker for civil, nautical and astronomical twilight and night
+    (as astroplan's `brightness_shading`), from the altitude of the Sun at `x`.
+    '''
+    level = np.digitize(-np.asarray(sun_alt), [0, 6, 12, 18])  # 0 (day) to 4 (night)
+    edges = np.flatnonzero(np.diff(level)) + 1
+    for i0, i1 in zip(np.r_[0, edges], np.r_[edges, len(x) - 1]):  # runs of the same level
+        if level[i0] > 0:
+            ax.axvspan(x[i0], x[i1], color="grey", alpha=0.1*level[i0], linewidth=0)
+
+
+def format_altitude_axes(ax, x, min_alt, max_alt=90):
+    ''' Time axis in HH:MM and the secondary airmass axis (as astroplan's `plot_altitude`).
+    '''
+    from matplotlib import dates
+
+    ax.set_xlim(x[0], x[-1])
+    ax.xaxis.set_major_locator(dates.AutoDateLocator())
+    ax.xaxis.set_major_formatter(dates.DateFormatter('%H:%M'))
+    for label in ax.get_xticklabels():
+        label.set(rotation=30, ha="right")
+    ax.set_ylim(min_alt, max_alt)
+    ax.set_ylabel("Altitude")
+    ax.set_xlabel(f"Time from {dates.num2date(x[0]).date()} [UTC]")
+
+    airmass_ticks = np.array([1, 2, 3])
+    ax2 = ax.twinx()
+    ax2.set_yticks(90 - np.degrees(np.arccos(1/airmass_ticks)))
+    ax2.set_yticklabels(airmass_ticks)
+    ax2.set_ylim(ax.get_ylim())
+    ax2.set_ylabel('Airmass')
+
+
+def html_cells(column, escape=False):
+    ''' The cells of a column as an array of strings, formatted at once (as `to_html` does:
+    floats with the common number of decimals, missing values as "NaN").
+    '''
+    values = column.to_numpy()
+    isna = pd.isna(values)
+    if column.dtype.kind == "f":
+        finite = values[~isna]
+        for ndec in range(1, 7):
+            if np.all(np.round(finite, ndec) == finite):
+                break
+        cells = np.char.mod(f"%.{ndec}f", np.where(isna, 0, values))
+    else:
+        cells = np.char.strip(values.astype(str))
+    cells = np.where(isna, "NaN", cells)
+    if escape:  # (np.char.replace may truncate the fixed-width strings)
+        cells = pd.Series(cells, dtype=object)
+        for char, code in [("&", "&amp;"), ("<", "&lt;"), (">", "&gt;")]:
+            cells = cells.str.replace(char, code, regex=False)
+        cells = cells.to_numpy(dtype=str)
+    return cells
+
+
+def write_table(table, output, fmt="html", escape=False, head=""):
+    ''' Write the DataFrame to the file object `output` as HTML (cells are escaped only if
+    `escape`; `head`, e.g., a style sheet, is written before the table), CSV or JSON. The
+    HTML is written row by row from a template, so the whole document is never held as
+    one string.
+    '''
+    if fmt == "csv":
+        table.to_csv(output, index=False)
+        return
+    elif fmt == "json":
+        table.to_json(output, orient="records", indent=1, force_ascii=False)
+        return
+
+    cells = [html_cells(table[col], escape=escape) for col in table.columns]
+    output.write(head)
+    output.write('<pre><table border="1" class="dataframe">\n  <thead>\n'
+                 '    <tr style="text-align: right;">\n')
+    output.write("".join(f"      <th>{col}</th>\n" for col in table.columns))
+    output.write("    </tr>\n  </thead>\n  <tbody>\n")
+    row_template = "    <tr>\n" + "      <td>{}</td>\n"*len(cells) + "    </tr>\n"
+    for row in zip(*cells):
+        output.write(row_template.format(*row))
+    output.write("  </tbody>\n</table></pre>")
+
+
+def table2str(table, fmt="html", escape=False):
+    ''' The DataFrame as a string by `write_table`.
+    '''
+    output = io.StringIO()
+    write_table(table, output, fmt, escape)
+    return output.getvalue()
+
+
+def save_table(table, path, fmt="html", escape=False, head=""):
+    ''' Save the DataFrame by `write_table`.
+    '''
+    with open(path, "w+") as output:
+        write_table(table, output, fmt, escape, head=head)
+
+
+def embed_sprites(spritedir, stems):
+    ''' Sprite sheets of only the images `stems`, cut from the sheets of
+    `onetime_downloader.py` in `spritedir` and embedded in a style sheet as data URIs, so
+    that the page needs no other file.
+
+    Returns
+    -------
+    head : str
+        The ``<style>`` element, for `save_table`.
+    sprites : dict
+        ``{stem: (kind, x, y, width, height)}``, the positions of the images [px] in the
+        new sheets, for `make_table`. Images not in the sheets are not included.
+    '''
+    import base64
+
+    from PIL import Image
+
+    with open(Path(spritedir)/"index.json") as index:
+        index = json.load(index)
+    css, sprites = [], {}
+    stems = [stem for stem in dict.fromkeys(stems) if stem in index["images"]]
+    for kind, sheet in index["sheets"].items():
+        _stems = [stem for stem in stems if index["images"][stem][0] == kind]
+        slots = list(dict.fromkeys(index["images"][stem][1] for stem in _stems))
+        if not slots:
+            continue
+        (tw, th), ncol = sheet["tile"], min(len(slots), sheet["columns"])
+        compact = Image.new("RGB", (ncol*tw, -(-len(slots)//ncol)*th), "white")
+        with Image.open(Path(spritedir)/sheet["file"]) as full:
+            for i, slot in enumerate(slots):
+                x, y = (slot % sheet["columns"])*tw, (slot//sheet["columns"])*th
+                compact.paste(full.crop((x, y, x + tw, y + th)), ((i % ncol)*tw, (i//ncol)*th))
+        buffer = io.BytesIO()
+        compact.save(buffer, "JPEG", quality=sheet["quality"], optimize=True)
+        css.append(f".sp-{kind} {{background-image: url(data:image/jpeg;base64,"
+                   + f"{base64.b64encode(buffer.getvalue()).decode()})}}")
+        for stem in _stems:
+            _, slot, width, height = index["images"][stem]
+            i = slots.index(slot)
+            sprites[stem] = (kind, (i % ncol)*tw, (i//ncol)*th, width, height)
+    return "<style>\n" + "\n".join(css) + "\n</style>\n", sprites
+
+
+def select_catalog(cat, targets=None, messier=True, caldwell=True, types=None,
+                   type_exclude=False, nickname=False, verbose=False):
+    ''' Select objects of `cat` by the user's criteria (see the command-line options).
+    If `targets` (list of IDs) is given, all the other criteria are ignored.
+    '''
+    if targets is not None:
+        cat = cat[cat["ID"].isin(targets)]
+        if verbose:
+            print(f"Choosing only thses: {targets}")
+    else:
+        if not messier:
+            if verbose:
+                print("Messier objects are ignored.")
+            cat = cat[~cat["ID"].str.startswith("M")]
+        if not caldwell:
+            if verbose:
+                print("Caldwell objects are ignored.")
+            cat = cat[~cat["ID"].str.startswith("C")]
+        if types is not None:
+            if type_exclude:
+                cat = cat[~cat["Type"].isin(types)]
+                if verbose:
+                    print(f"Following types will be ignored: {types}")
+            else:
+                cat = cat[cat["Type"].isin(types)]
+                if verbose:
+                    print(f"Only take the following types: {types}")
+
+        if nickname:
+            if verbose:
+                print("Only those with common nicknames are selected.")
+            cat = cat[cat["Name"].notna()]
+
+    if verbose:
+        print(f"{len(cat)} objects are selected by the user.")
+    return cat
+
+
+def time_grid(obstime, duration):
+    ''' Times for the plot (around once per 5 minutes within `obstime` ± `duration` [hour])
+    and for all the transforms (-`duration`, 0, +`duration`, followed by the former).
+    '''
+    dt = duration*u.hour
+    offsets = np.linspace(-1, 1, max(6, int(duration*12)))
+    return obstime + offsets*dt, obstime + np.concatenate([[-1, 0, 1], offsets])*dt
+
+
+def find_visible(cat, index, observer, obstime, duration, min_alt, always=False,
+                 cache_dir=None, planets=False, verbose=False):
+    ''' Objects of `cat` above `min_alt` [deg] within `obstime` ± `duration` [hour].
+
+    Parameters
+    ----------
+    cat : DataFrame
+        The (selected) catalog. Its index must be that of the catalog of `index`.
+    index : dict
+        The index from `build_index`, for the pre-filter.
+    always : bool, optional
+        Whether the objects must be above `min_alt` all the time.
+    cache_dir : path-like, optional
+        Directory of the transform cache; if `None`, the exact transformation is used.
+    planets : bool, optional
+        Whether to return the planets from the cache (for the plot).
+
+    Returns
+    -------
+    cat_up : DataFrame
+        The visible objects, sorted by DEC (descending), with a new index.
+    alt_range : ndarray
+        Altitudes [deg] at -`duration`, 0, +`duration`, shape ``(len(cat_up), 3)``.
+    alt : ndarray
+        Altitudes [deg] at the plotting times of `time_grid`.
+    xyz_pl : ndarray or None
+        AltAz vectors of `PLANETS` at the plotting times (`None` if no `cache_dir` or not
+        `planets`).
+    '''
+    loc = observer.location
+    _, alltimes = time_grid(obstime, duration)
+
+    # Discard objects that cannot reach min_alt before any transformation. Only by
+    # declination if the whole range of LST is covered.
+    with span("pre-filter"):
+        lst = (None if duration >= 12
+               else alltimes[[0, 2]].sidereal_time("mean", longitude=loc.lon).deg)
+        cat = cat[cat.index.isin(query_index(index, loc.lat.deg, min_alt, lst=lst))]
+        if verbose:
+            print(f"{len(cat)} objects pass the declination/hour angle pre-filter.")
+        cat = cat.sort_values(by="DEC", ascending=False, ignore_index=True)
+
+    if cache_dir is None:
+        rot, xyz_pl = None, None
+    else:
+        with span("transform cache"):
+            rot, xyz_pl = load_transform_cache(loc, alltimes, cache_dir, planets=planets)
+            xyz_pl = None if xyz_pl is None else xyz_pl[:, 3:]
+
+    with span("targets"):
+        coo = SkyCoord(ra=cat["RA"].values*u.deg, dec=cat["DEC"].values*u.deg)
+    with span("altaz"):
+        ha, dec = target_hadec(coo, loc, obstime, rot=None if rot is None else rot[1])
+    with span("observability mask"):
+        alt_min, alt_max = altitude_range(ha, dec, loc.lat.deg, duration)
+        upmask = check_observable_range(min_alt, alt_min, alt_max, always)
+    if verbose:
+        print(f"{np.sum(upmask)} objects are visible by the user's criteria.")
+    dhours = (alltimes - obstime).to_value(u.hour)
+    alt = altitude_at(ha[upmask], dec[upmask], loc.lat.deg, dhours)
+    return cat[upmask].reset_index(drop=True), alt[:, :3], alt[:, 3:], xyz_pl
+
+
+def schedule_night(cat, observer, obstime, duration, min_alt, dwell=SCHEDULE_DWELL,
+                   slew_rate=SLEW_RATE, settle=SLEW_SETTLE, slew_cost=SLEW_COST, cache_dir=None):
+    ''' Observing sequence of the objects of `cat` within `obstime` ± `duration` [hour].
+
+    Built greedily in time: after each object (or at the start), every remaining object is
+    evaluated at once for the next slot (slew from the current one, then `dwell` [min] on it)
+    and the best one is taken. An object must stay above `min_alt` [deg] during its slot
+    (exactly, by `altitude_range`), and the best is the closest to its own best altitude
+    within the window, where each minute of slew counts as `slew_cost` [deg] below it. The
+    slew takes the larger of the RA and DEC offsets over `slew_rate` [deg/s], plus `settle`
+    [s]. If no object fits, the slot starts a minute later.
+
+    Returns
+    -------
+    table : DataFrame
+        One row per slot, in time order: local start and end times, the object, its
+        altitudes at the start and end and its best altitude within the window [deg], and
+        the slew to it [deg].
+    '''
+    loc = observer.location
+    lat = loc.lat.deg
+    coo = SkyCoord(ra=cat["RA"].values*u.deg, dec=cat["DEC"].values*u.deg)
+    rot = (None if cache_dir is None
+           else load_transform_cache(loc, obstime.reshape((1,)), cache_dir)[0][0])
+    ha, dec = target_hadec(coo, loc, obstime, rot=rot)
+    _, alt_best = altitude_range(ha, dec, lat, duration)
+    ra_icrs, dec_icrs = cat["RA"].to_numpy(dtype=float), cat["DEC"].to_numpy(dtype=float)
+
+    dwell_h = dwell/60
+    todo = np.ones(len(cat), dtype=bool)
+    now, current = -duration, None
+    idx, t_beg, slews = [], [], []
+    while now + dwell_h <= duration and todo.any():
+        if current is None:
+            slew = np.zeros(len(cat))
+        else:
+            dra = np.abs((ra_icrs - ra_icrs[current] + 180) % 360 - 180)
+            slew = np.maximum(dra, np.abs(dec_icrs - dec_icrs[current]))
+        slew_h = (slew/slew_rate + settle*(slew > 0))/3600
+        t_mid = now + slew_h + dwell_h/2
+        alt_min, _ = altitude_range(ha + SIDEREAL_RATE*t_mid, dec, lat, dwell_h/2)
+        alt_mid = altitude_at(ha, dec, lat, t_mid[:, np.newaxis])[:, 0]
+        fits = todo & (t_mid + dwell_h/2 <= duration) & (alt_min >= min_alt)
+        if not fits.any():
+            now += 1/60
+            continue
+        merit = np.where(fits, alt_mid - alt_best - slew_cost*slew_h*60, -np.inf)
+        current = np.argmax(merit)
+        idx.append(current)
+        t_beg.append(t_mid[current] - dwell_h/2)
+        slews.append(slew[current])
+        todo[current] = False
+        now = t_mid[current] + dwell_h/2
+
+    idx, t_beg = np.array(idx, dtype=int), np.array(t_beg)
+    t_end = t_beg + dwell_h
+    alts = altitude_at(ha[idx], dec[idx], lat, np.stack([t_beg, t_end], axis=-1))
+    tz = observer.timezone
+    table = pd.DataFrame({
+        "Start": [f"{_t:%H:%M}" for _t in (obstime + t_beg*u.hour).to_datetime(timezone=tz)],
+        "End": [f"{_t:%H:%M}" for _t in (obstime + t_end*u.hour).to_datetime(timezone=tz)],
+    })
+    table = pd.concat([table, cat.iloc[idx][["ID", "Other ID", "Name", "Type", "Mag"]]
+                       .reset_index(drop=True)], axis=1)
+    table["Alt_start"] = np.round(alts[:, 0], 2)
+    table["Alt_end"] = np.round(alts[:, 1], 2)
+    table["Alt_best"] = np.round(alt_best[idx], 2)
+    table["Slew"] = np.round(np.array(slews, dtype=float), 1)
+    return table
+
+
+def sky_frames(cat, observer, obstime, duration, step=FRAME_STEP, chunk=FRAME_CHUNK,
+               cache_dir=None):
+    ''' Generator of the sky every `step` [min] within `obstime` ± `duration` [hour].
+
+    The frames are computed `chunk` at a time: one batched target × time matrix from the
+    hour angles (`altaz_at`), and the planets, the Moon and the Sun at the same times. The
+    memory is therefore the same for any number of frames.
+
+    Yields
+    ------
+    frame : dict
+        ``time`` (Time), the altitudes and azimuths [deg] of the objects of `cat` (``alt``,
+        ``az``, shape ``(len(cat),)``), of `PLANETS` (``alt_pl``, ``az_pl``) and of the Moon
+        (``alt_moon``, ``az_moon``), and the altitude of the Sun (``alt_sun``).
+    '''
+    loc = observer.location
+    coo = SkyCoord(ra=cat["RA"].values*u.deg, dec=cat["DEC"].values*u.deg)
+    rot = (None if cache_dir is None
+           else load_transform_cache(loc, obstime.reshape((1,)), cache_dir)[0][0])
+    ha, dec = target_hadec(coo, loc, obstime, rot=rot)
+    dhours = np.arange(-duration, duration + 1e-9, step/60)
+    for i in range(0, len(dhours), chunk):
+        times = obstime + dhours[i:i + chunk]*u.hour
+        alt, az = altaz_at(ha, dec, loc.lat.deg, dhours[i:i + chunk])
+        if cache_dir is None:
+            altaz = AltAz(obstime=times, location=loc)
+            xyz_pl = np.array([get_body(planet, time=times, location=loc).transform_to(altaz)
+                               .cartesian.xyz.value.T for planet in PLANETS])
+        else:
+            xyz_pl = load_transform_cache(loc, times, cache_dir, planets=True)[1]
+        alt_pl, _ = xyz2alt(xyz_pl)
+        az_pl = np.rad2deg(np.arctan2(xyz_pl[..., 1], xyz_pl[..., 0])) % 360
+        moon = observer.moon_altaz(times)
+        alt_moon, az_moon = moon.alt.deg, moon.az.deg
+        alt_sun = observer.sun_altaz(times).alt.deg
+        for j in range(len(times)):
+            yield dict(time=times[j], alt=alt[:, j], az=az[:, j], alt_pl=alt_pl[:, j],
+                       az_pl=az_pl[:, j], alt_moon=alt_moon[j], az_moon=az_moon[j],
+                       alt_sun=alt_sun[j])
+
+
+def write_snapshots(frames, output, ids, tz, min_alt=0.):
+    ''' Write each frame of `sky_frames` to the file object `output` as one line of JSON as
+    soon as it is computed (flushed, for a reader at the other end of a pipe). Only the
+    objects and planets above `min_alt` [deg] are listed, as ``{name: [alt, az]}``.
+    '''
+    ids = np.asarray(ids, dtype=str)
+    names_pl = np.array(list(PLANETS))
+    for frame in frames:
+        up, up_pl = frame["alt"] > min_alt, frame["alt_pl"] > min_alt
+        snap = dict(
+            time=frame["time"].utc.isot,
+            local=frame["time"].to_datetime(timezone=tz).isoformat(timespec="seconds"),
+            sun=dict(alt=round(float(frame["alt_sun"]), 2)),
+            moon=dict(alt=round(float(frame["alt_moon"]), 2),
+                      az=round(float(frame["az_moon"]), 2)),
+            planets=dict(zip(names_pl[up_pl], np.round(
+                np.stack([frame["alt_pl"][up_pl], frame["az_pl"][up_pl]], axis=-1), 2).tolist())),
+            targets=dict(zip(ids[up], np.round(
+                np.stack([frame["alt"][up], frame["az"][up]], axis=-1), 2).tolist())),
+        )
+        output.write(json.dumps(snap) + "\n")
+        output.flush()
+
+
+def save_animation(frames, path, labels, tz, min_alt=30., fps=FRAME_FPS):
+    ''' Draw the frames of `sky_frames` one at a time as an alt-az sky map (North up, East
+    left, as seen looking up) with the objects (`labels`), planets, the Moon, the `min_alt`
+    circle and the twilight as the background.
+
+    If `path` has a suffix, a movie is saved: ``.gif`` by Pillow (which keeps the frames
+    until the end), others by ffmpeg (streamed). Otherwise, one PNG file per frame is saved
+    in the directory `path`.
+    '''
+    plt = setup_plot()
+    from matplotlib import animation
+
+    fig, ax = plt.subplots(1, 1, figsize=(8, 8.5), subplot_kw=dict(projection="polar"))
+    ax.set_theta_zero_location("N")  # azimuth counterclockwise: East to the left
+    ax.set_rlim(0, 90)
+    ax.set_xticks(np.deg2rad([0, 90, 180, 270]), ["N", "E", "S", "W"])
+    ax.set_yticks([0, 30, 60, 90], ["90˚", "60˚", "30˚", "0˚"])
+    ax.plot(np.linspace(0, 2*np.pi, 361), np.full(361, 90 - min_alt), "k--", lw=1)
+    targets = ax.scatter(np.zeros(0), np.zeros(0), s=12, color="tab:blue")
+    texts = [ax.text(0, 0, label, fontsize=7, visible=False) for label in labels]
+    colors_pl = np.array(list(PLANETS.values()))
+    planets = ax.scatter(np.zeros(0), np.zeros(0), s=80, alpha=0.7)
+    moon = ax.scatter([0], [0], s=400, color="gray", alpha=0.5)
+
+    def draw(frame):
+        up = frame["alt"] > 0
+        theta, r = np.deg2rad(frame["az"]), 90 - frame["alt"]
+        targets.set_offsets(np.stack([theta[up], r[up]], axis=-1))
+        for text, _up, _theta, _r in zip(texts, up, theta, r):
+            text.set_visible(_up)
+            text.set_position((_theta, _r))
+        up_pl = frame["alt_pl"] > 0
+        planets.set_offsets(np.stack([np.deg2rad(frame["az_pl"][up_pl]),
+                                      90 - frame["alt_pl"][up_pl]], axis=-1))
+        planets.set_color(colors_pl[up_pl])
+        moon.set_offsets([[np.deg2rad(frame["az_moon"]), 90 - frame["alt_moon"]]])
+        moon.set_visible(frame["alt_moon"] > 0)
+        level = np.digitize(-frame["alt_sun"], [0, 6, 12, 18])  # as `plot_twilight`
+        ax.set_facecolor((0, 0, 0, 0.1*level))
+        ax.set_title(f"{frame['time'].to_datetime(timezone=tz):%Y-%m-%d %H:%M %Z}")
+
+    path = Path(path)
+    if path.suffix:
+        name = "pillow" if path.suffix.lower() == ".gif" else "ffmpeg"
+        if not animation.writers.is_available(name):
+            print(f"{name} is not available for {path}; give a directory for PNG files instead.")
+            return
+        writer = animation.writers[name](fps=fps)
+        with writer.saving(fig, str(path), dpi=100):
+            for frame in frames:
+                draw(frame)
+                writer.grab_frame()
+    else:
+        path.mkdir(parents=True, exist_ok=True)
+        for i, frame in enumerate(frames):
+            draw(frame)
+            fig.savefig(path/f"frame{i:04d}.png", dpi=100)
+    plt.close(fig)
+
+
+def load_sites(path):
+    ''' Read the sites from a CSV file with columns ``name``, ``lon``, ``lat`` [deg] and,
+    optionally, ``height`` [m] (500 m if not given). Other columns are ignored.
+    '''
+    sites = pd.read_csv(path, comment="#", skipinitialspace=True)
+    if "height" not in sites:
+        sites["height"] = 500.
+    return sites[["name", "lon", "lat", "height"]]
+
+
+def find_visible_sites(cat, index, sites, obstime, duration, min_alt, always=False,
+                       verbose=False):
+    ''' `find_visible` for all `sites` (from `load_sites`) at once.
+
+    All sites share the time grid (the same instants, `obstime` ± `duration` [hour]) and
+    the transformation is vectorized over site × target × time (exact: it is a single one,
+    so the transform cache would only add per-site work).
+
+    Returns
+    -------
+    table : DataFrame
+        Rows of (site, visible object), as `make_table` with plain values, with the site
+        name in the first column.
+    '''
+    locs = EarthLocation.from_geodetic(sites["lon"].values*u.deg, sites["lat"].values*u.deg,
+                                       sites["height"].values*u.m)
+    _, alltimes = time_grid(obstime, duration)
+
+    # Pre-filter: union of the objects that can be visible from any of the sites.
+    if duration >= 12:
+        lsts = [None]*len(sites)
+    else:
+        gmst = alltimes[[0, 2]].sidereal_time("mean", longitude=0).deg
+        lsts = [gmst + _lon for _lon in sites["lon"]]
+    labels = [query_index(index, _lat, min_alt, lst=_lst)
+              for _lat, _lst in zip(sites["lat"], lsts)]
+    cat = cat[cat.index.isin(np.concatenate(labels))]
+    if verbose:
+        print(f"{len(cat)} objects pass the declination/hour angle pre-filter of any site.")
+    cat = cat.sort_values(by="DEC", ascending=False, ignore_index=True)
+
+    coo = SkyCoord(ra=cat["RA"].values*u.deg, dec=cat["DEC"].values*u.deg)
+    # One transform at `obstime` for all sites, then the hour angles (see `find_visible`).
+    frame = AltAz(obstime=obstime, location=locs[:, np.newaxis])
+    xyz = np.moveaxis(coo[np.newaxis, :].transform_to(frame).cartesian.xyz.value, 0, -1)
+    lats = sites["lat"].values[:, np.newaxis]
+    ha, dec = hadec_from_altaz(xyz, lats)
+    upmask = check_observable_range(min_alt, *altitude_range(ha, dec, lats, duration), always)
+    alt = altitude_at(ha, dec, lats, [-duration, 0, duration])
+
+    tables = []
+    for name, _mask, _alt in zip(sites["name"], upmask, alt):
+        table = make_table(cat[_mask].reset_index(drop=True), _alt[_mask], fmt="csv")
+        table.insert(0, "Site", name)
+        tables.append(table)
+        if verbose:
+            print(f"{name}: {np.sum(_mask)} objects are visible by the user's criteria.")
+    return pd.concat(tables, ignore_index=True)
+
+
+def alt_colnames(localtime, duration):
+    ''' Names of the three altitude columns of the HTML table.
+    '''
+    return [
+        f"- {duration:.0f} hr<br>altitude",
+        f"{localtime:%y-%m-%d}<br>{localtime:%H:%M}<br>altitude",
+        f"+ {duration:.0f} hr<br>altitude"
+    ]
+
+
+def make_table(cat_up, alt_range, fmt="html", min_alt=30., colnames=None, figdir="figs",
+               scores=None, rank=False, sprites=None):
+    ''' The table of the visible objects (from `find_visible`), sorted by Type and DEC.
+
+    For HTML, the cells are formatted (wiki links, images in `figdir`, altitudes colored by
+    `min_alt`) and `colnames` (see `alt_colnames`) are the names of the altitude columns.
+    Otherwise, plain values are used. The `scores` (from `score_targets`) are appended as
+    columns, and if `rank`, the table is sorted by the score instead (best first). If
+    `sprites` (from `embed_sprites`) is given, the images are tiles of the sprite sheets
+    instead of the files in `figdir`.
+    '''
+    if scores is not None:
+        cat_up = pd.concat([cat_up, scores], axis=1)
+    if rank:
+        table = cat_up.sort_values(by="Score", ascending=False, na_position="last", kind="stable")
+    else:
+        table = cat_up.sort_values(by=["Type", "DEC"], ascending=False)
+    alts_beg, alts_mid, alts_end = alt_range[table.index].T
+    table = table.reset_index(drop=True)
+
+    if fmt != "html":
+        for i, (alts, col) in enumerate(zip([alts_beg, alts_mid, alts_end],
+                                            ["Alt_beg", "Alt_mid", "Alt_end"])):
+            table.insert(loc=i+4, column=col, value=np.round(alts, 2))
+        return table
+
+    # All cells are formatted column-wise by numpy string operations.
+    ids = table["ID"].to_numpy(dtype=str)
+    stems = image_stems(ids)
+    if sprites is None:
+        table["lowres"] = _concat(f'<img src="{figdir}/', stems["lowres"], '.jpg">')
+        table["DSS"] = _concat(f'<img src="{figdir}/', stems["DSS"], '.jpg" width=200px>')
+        table["DSS-zscale"] = _concat(f'<img src="{figdir}/', stems["DSS-zscale"],
+                                      '.jpg" width=200px>')
+    else:
+        for kind, _stems in stems.items():
+            table[kind] = sprite_cells(_stems, sprites)
+    _radec = _concat(table["RA"].to_numpy(dtype=str), "<br>", table["DEC"].to_numpy(dtype=str))
+    table.insert(loc=3, column="RADEC[˚]", value=_radec)
+    othids = table["Other ID"].fillna("").to_numpy(dtype=str)
+    table["ID"] = _concat("<b>", mk_wikilink(ids), "</b><br><br>", othids)  # Add wiki links.
+
+    for i, (alts, col) in enumerate(zip([alts_beg, alts_mid, alts_end], colnames)):
+        table.insert(loc=i+3, column=col, value=alt_color(alts, min_alt=min_alt))
+
+    table.drop(columns=COLS2DROP, inplace=True, errors="ignore")
+    return table
+
+
+def serve(host, port, cat, index, defaults, cache_dir=None, figdir=None, verbose=False):
+    ''' Answer "what is up now" queries over HTTP, keeping the catalog, the observers, the
+    IERS tables and the transform caches warm in memory.
+
+    ``GET /up?lat=37.5&lon=127&min_alt=40&types=gal-S,gal-E&format=json`` returns the table
+    of `make_table` (as `table2str`). The query parameters are ``lon``, ``lat`` [deg],
+    ``tz``, ``time`` (local time in ISO format, e.g., ``2021-11-12T20:30``; default: now),
+    ``duration`` [hour], ``min_alt`` [deg], ``always``, ``targets``, ``messier``,
+    ``caldwell``, ``types``, ``exclude``, ``nickname`` (comma-separated for lists, 0/1 for
+    flags) and ``format`` (html, csv, json). Missing ones are taken from `defaults` (a dict
+    of the same keys). Images in `figdir` are served under ``/figs/``. Identical queries
+    within the same minute are answered from memory.
+    '''
+    import functools
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs, urlsplit
+
+    lock = threading.Lock()  # astropy transforms (and the cache files) are not thread-safe.
+
+    @functools.lru_cache(maxsize=32)
+    def _observer(lon, lat, tzname):
+        loc = EarthLocation.from_geodetic(lon*u.deg, lat*u.deg, 500*u.m)
+        return ap.Observer(location=loc, timezone=pytz.timezone(tzname))
+
+    @functools.lru_cache(maxsize=256)
+    def _answer(lon, lat, tzname, localtime, duration, min_alt, always, targets,
+                messier, caldwell, types, exclude, nickname, fmt):
+        observer = _observer(lon, lat, tzname)
+        _cat = select_catalog(cat, targets=targets, messier=messier, caldwell=caldwell,
+                              types=types, type_exclude=exclude, nickname=nickname)
+        cat_up, alt_range, _, _ = find_visible(
+            _cat, index, observer, Time(localtime), duration, min_alt, always=always,
+            cache_dir=cache_dir
+        )
+        table = make_table(cat_up, alt_range, fmt=fmt, min_alt=min_alt,
+                           colnames=alt_colnames(localtime, duration), figdir="figs")
+        return table2str(table, fmt)
+
+    def _parse(query):
+        q = {**defaults, **{k: v[-1] for k, v in parse_qs(query).items()}}
+        for key in ["lon", "lat", "duration", "min_alt"]:
+            q[key] = float(q[key])
+        if not -90 <= q["lat"] <= 90:
+            raise ValueError(f"lat must be in [-90, 90]: {q['lat']}")
+        if not -180 <= q["lon"] <= 360:
+            raise ValueError(f"lon must be in [-180, 360]: {q['lon']}")
+        if not 0 < q["duration"] <= 12:  # also False for NaN
+            raise ValueError(f"duration must be in (0, 12]: {q['duration']}")
+        if not -90 <= q["min_alt"] <= 90:
+            raise ValueError(f"min_alt must be in [-90, 90]: {q['min_alt']}")
+        for key in ["always", "messier", "caldwell", "exclude", "nickname"]:
+            if isinstance(q[key], str):
+                q[key] = q[key].lower() in ("1", "true", "yes")
+        for key in ["targets", "types"]:
+            if isinstance(q[key], str):
+                q[key] = q[key].split(",")
+            q[key] = None if q[key] is None else tuple(q[key])
+        if q["format"] not in ("html", "csv", "json"):
+            raise ValueError(f"Unknown format: {q['format']}")
+        tz = pytz.timezone(q["tz"])
+        if q.get("time"):
+            localtime = datetime.datetime.fromisoformat(q["time"])
+            if localtime.tzinfo is None:
+                localtime = tz.localize(localtime)
+        else:
+            localtime = datetime.datetime.now(tz).replace(second=0, microsecond=0)
+        return (q["lon"], q["lat"], q["tz"], localtime, q["duration"], q["min_alt"],
+                q["always"], q["targets"], q["messier"], q["caldwell"], q["types"],
+                q["exclude"], q["nickname"], q["format"])
+
+    ctypes = {"html": "text/html; charset=utf-8", "csv": "text/csv; charset=utf-8",
+              "json": "application/json"}
+
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, code, ctype, body):
+            self.send_response(code)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path.startswith("/figs/") and figdir is not None:
+                fpath = Path(figdir)/Path(url.path).name
+                if fpath.is_file():
+                    return self._send(200, "image/jpeg", fpath.read_bytes())
+                return self._send(404, "text/plain; charset=utf-8", b"Not found")
+            if url.path not in ("/", "/up"):
+                return self._send(404, "text/plain; charset=utf-8", b"Not found")
+            try:
+                key = _parse(url.query)
+            except (KeyError, ValueError, pytz.UnknownTimeZoneError) as err:
+                return self._send(400, "text/plain; charset=utf-8",
+                                  f"Bad query: {err!r}".encode())
+            try:
+                with lock:
+                    body = _answer(*key)
+            except Exception as err:  # reply, rather than drop the connection
+                return self._send(500, "text/plain; charset=utf-8",
+                                  f"Server error: {err!r}".encode())
+            self._send(200, ctypes[key[-1]], body.encode("utf-8"))
+
+        def log_message(self, *args):
+            if verbose:
+                super().log_message(*args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f"Serving on http://{host}:{port}/up (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def _current_location(url, cache_dir=None, ttl=LOCATION_TTL, timeout=LOCATION_TIMEOUT,
+                      offline=False):
+    ''' The answer of `url` (ip-api.com or a stand-in), saved in `cache_dir` and reused for
+    `ttl` hours. If the lookup fails or takes more than `timeout` seconds in total (DNS
+    resolution included), or is not even tried (if `offline`), the last saved answer (even
+    if older than `ttl`) is returned, or `None` if there is none.
+    '''
+    fpath = None if cache_dir is None else Path(cache_dir)/"location.json"
+    saved = None
+    if fpath is not None and fpath.exists():
+        try:
+            saved = json.loads(fpath.read_text())
+        except ValueError:  # corrupted file: look it up again
+            pass
+    now = datetime.datetime.now(datetime.timezone.utc).timestamp()
+    if saved is not None and now - saved["saved_at"] < ttl*3600:
+        return saved
+    if offline:
+        if saved is None:
+            print("No known current location (offline); --location is used.")
+        return saved
+
+    import threading
+    from concurrent import futures
+    from requests import RequestException, get
+
+    # The timeout of requests does not cover the DNS resolution, so the lookup runs in a
+    # daemon thread which is simply abandoned (not joined at exit) if it is late.
+    lookup = futures.Future()
+
+    def _lookup():
+        try:
+            lookup.set_result(get(url, timeout=timeout).json())
+        except Exception as err:
+            lookup.set_exception(err)
+
+    threading.Thread(target=_lookup, daemon=True).start()
+    try:
+        try:
+            response = lookup.result(timeout=timeout)
+        except futures.TimeoutError:
+            raise RequestException(f"no answer in {timeout} s") from None
         # {'status': 'success', 'country': 'South Korea', 'countryCode': 'KR',
         # 'region': '11', 'regionName': 'Seoul', 'city': 'Gwanak-gu', 'zip': '08841',
         # 'lat': 37.4625, 'lon': 126.9438, 'timezone': 'Asia/Seoul', 'isp': 'SNU',
         # 'org': '', 'as': 'AS9488 Seoul National University', 'query': '147.46.135.73'}
+        if response.get("status", "success") != "success":
+            raise ValueError(response.get("message", response))
+    except (RequestException, ValueError) as err:
+        print(f"Failed to find the current location ({err!r}); "
+              + ("the last known one is used." if saved else "--location is used."))
+        return saved
+
+    response["saved_at"] = now
+    if fpath is not None:
+        fpath.parent.mkdir(parents=True, exist_ok=True)
+        tmppath = fpath.with_suffix(f".{os.getpid()}.tmp")
+        tmppath.write_text(json.dumps(response))
+        os.replace(tmppath, fpath)
+    return response
+
+
+def get_geoloc(use_current_location, verbose, location=(127, 37.5), timezone="Asia/Seoul",
+               cache_dir=None, ttl=LOCATION_TTL, timeout=LOCATION_TIMEOUT, url=GEOIP_URL,
+               offline=False):
+    ''' Find geological location information from ip-api.com (lon, lat, timezone).
+    If not `use_current_location`, `location` (lon, lat) [deg] and `timezone` are used.
+    The current location is cached (see `_current_location`); `location` and `timezone` are
+    also the fallback when it cannot be found.
+    '''
+    response = None
+    if use_current_location:
+        # ip-api.com answers for the IP address of the request itself.
+        response = _current_location(url, cache_dir=cache_dir, ttl=ttl, timeout=timeout,
+                                     offline=offline)
+        if verbose:
+            print(response)
+    if response is not None:
         lon = float(response['lon'])*u.deg
         lat = float(response['lat'])*u.deg
         tz = pytz.timezone(response['timezone'])
-        if verbose:
-            print(response)
     else:
-        lon = float(args.location[0])*u.deg
-        lat = float(args.location[1])*u.deg
-        tz = pytz.timezone(args.timezone)
+        lon = float(location[0])*u.deg
+        lat = float(location[1])*u.deg
+        tz = pytz.timezone(timezone)
     return lon, lat, tz
 
 
@@ -185,12 +1680,6 @@ def get_time(YYYY, MM, DD, HH, mm, ss, in_utc, tz):
     '''
     if YYYY is None:
         _obstime = datetime.datetime.utcnow()
-        _localnow = datetime.datetime.now()
-        args.YYYY = _localnow.year
-        args.MM = _localnow.month
-        args.DD = _localnow.day
-        args.HH = _localnow.hour
-        args.mm = _localnow.minute
     else:
         YYYY = int(YYYY)
         MM = int(MM)
@@ -205,64 +1694,138 @@ def get_time(YYYY, MM, DD, HH, mm, ss, in_utc, tz):
     return _obstime
 
 
-def add2kw(kw, cat, coo, mask, cmap):
+def add2kw(kw, cat, alt, mask, cmap):
     count = np.sum(mask)
     kw["df"] = cat[mask]
-    kw["coo"] = coo[mask]
+    kw["alt"] = alt[mask]
     kw["colors"] = cmap(np.linspace(0, 1, count))
 
 
+def _concat(*parts):
+    ''' Element-wise concatenation of string arrays (and scalars). '''
+    out = parts[0]
+    for part in parts[1:]:
+        out = np.char.add(out, part)
+    return out
+
+
+def image_stems(catid):
+    ''' File names (without ".jpg") of the images of (an array of) catalog IDs in `figs/`,
+    for each column of the HTML table.
+    '''
+    catid = np.asarray(catid, dtype=str)
+    if catid.size == 0:  # np.char.zfill fails on empty arrays
+        return {kind: catid for kind in ("lowres", "DSS", "DSS-zscale")}
+    nums = np.char.zfill(np.array([_id[1:] for _id in catid], dtype=str), 3)
+    return {"lowres": _concat(parseID(catid), "_", nums),
+            "DSS": _concat("DSS-200px-", catid),
+            "DSS-zscale": _concat("DSS-200px-", catid, "-zscale")}
+
+
+def sprite_cells(stems, sprites):
+    ''' HTML cells showing the tiles of `stems` in the sprite sheets (see `embed_sprites`).
+    '''
+    cells = []
+    for stem in stems:
+        if stem not in sprites:
+            cells.append("")
+            continue
+        kind, x, y, width, height = sprites[stem]
+        cells.append(f'<div class="sp-{kind}" style="width:{width}px;height:{height}px;'
+                     + f'background-position:-{x}px -{y}px"></div>')
+    return cells
+
+
 def parseID(catid):
-    if catid.startswith("M"):
-        catname = "Messier"
-    elif catid.startswith("C"):
-        catname = "Caldwell"
-    else:
-        catname = None
-    return catname
+    ''' "Messier", "Caldwell" or "None" for (an array of) catalog IDs. '''
+    catid = np.asarray(catid, dtype=str)
+    return np.where(np.char.startswith(catid, "M"), "Messier",
+                    np.where(np.char.startswith(catid, "C"), "Caldwell", "None"))
 
 
 def mk_wikilink(catid):
-    catname = parseID(catid)
-    url = f"https://en.wikipedia.org/wiki/{catname}_{catid[1:]}"
-    return f'<p style="font-size:large"><a href="{url}" title="Link">{catid:s}</a></p>'
-
+    catid = np.asarray(catid, dtype=str)
+    nums = np.array([_id[1:] for _id in catid.ravel()], dtype=str).reshape(catid.shape)
+    url = _concat("https://en.wikipedia.org/wiki/", parseID(catid), "_", nums)
+    return _concat('<p style="font-size:large"><a href="', url, '" title="Link">', catid,
+                   "</a></p>")
 
-def alt_color(alt):
-    altval = float(alt)
-    if altval < 0:
-        color = "red"
-    elif altval < args.min_alt:
-        color = "orange"
-    else:
-        color = "limegreen"
 
-    return f'<p style="color:{color}">{alt:.1f}˚</p>'
+def alt_color(alt, min_alt):
+    alt = np.asarray(alt, dtype=float)
+    color = np.where(alt < 0, "red", np.where(alt < min_alt, "orange", "limegreen"))
+    return _concat('<p style="color:', color, '">', np.char.mod("%.1f", alt), "˚</p>")
 
 
 if __name__ == "__main__":
+    _SPANS[0] = ("imports", _T0, time.perf_counter())
+    args = p.parse_args()
+    if args.profile is not None:
+        import atexit
+        _PROFILE = True
+        atexit.register(save_trace, args.profile, args.verbose)  # also at any sys.exit()
+    if args.cprofile is not None:
+        import atexit
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        atexit.register(lambda: (profiler.disable(), profiler.dump_stats(args.cprofile)))
+    if not args.no_plot:
+        try:
+            from rich import print
+            from rich.traceback import install
+            install()
+        except ImportError:
+            print("You may want to install `rich` by $ pip install rich")
+            pass
+
     if args.verbose:
         print(args)
 
     TOP = Path(__file__).parent
-    OUTPUT = Path(args.output) if args.output else Path("output.html")
+    OUTPUT = Path(args.output) if args.output else Path(f"output.{args.format or 'html'}")
+    FORMAT = args.format or {".csv": "csv", ".json": "json"}.get(OUTPUT.suffix, "html")
     FIGDIR = (TOP/"figs")#.relative_to(OUTPUT.parent)
     FIGDIR.mkdir(exist_ok=True, parents=True)
+    cache_dir = Path(args.cache_dir) if args.cache_dir else TOP/".cache"
+
+    # == Offline bundle ================================================================== #
+    if args.bundle:
+        try:
+            make_bundle(cache_dir/BUNDLE_DIR, ephemeris=args.ephemeris, verbose=args.verbose)
+        except OSError as err:
+            sys.exit(f"* Bundle not saved: {err}")
+        print(f"* Bundle saved to {cache_dir/BUNDLE_DIR}")
+        sys.exit()
+    if args.offline:
+        with span("bundle"):
+            bundle = load_bundle(cache_dir/BUNDLE_DIR, verbose=args.verbose)
 
     # == Get location and time information =============================================== #
-    lon, lat, tz = get_geoloc(args.currentlocation, args.verbose)
+    with span("geolocation"):
+        lon, lat, tz = get_geoloc(args.currentlocation, args.verbose, args.location,
+                                  args.timezone, cache_dir=None if args.no_cache else cache_dir,
+                                  ttl=args.location_ttl, timeout=args.location_timeout,
+                                  url=args.geoip_url, offline=args.offline)
     _obstime = get_time(args.YYYY, args.MM, args.DD,
                         args.HH, args.mm, args.ss,
                         args.UTC, tz)
+    if args.YYYY is None:  # For the column names of the output
+        _localnow = datetime.datetime.now()
+        args.YYYY = _localnow.year
+        args.MM = _localnow.month
+        args.DD = _localnow.day
+        args.HH = _localnow.hour
+        args.mm = _localnow.minute
 
     print(f"Date & Time : {_obstime} ({tz})")
     print(f"lon , lat  : {lon.value:.2f}˚, {lat.value:.2f}˚")
 
     OBSTIME = Time(_obstime)  # in UTC
-    dt = args.duration*u.hour
-    OBSTIME_RANGE = Time([OBSTIME - dt, OBSTIME, OBSTIME + dt])
-    OBSTIMES = OBSTIME + np.linspace(-dt, dt, max(6, int(args.duration*12)))
-    # around once per 5 minutes
+    if (args.offline and bundle is not None
+            and OBSTIME.utc.mjd + args.duration/24 > bundle["last_mjd"]):
+        print("The time is beyond the IERS-A table of the bundle; make a new one by --bundle.")
+    OBSTIMES, _ = time_grid(OBSTIME, args.duration)
 
     # NOTE: Default elevation of the observatory is set to 500m. Only small
     #   offset will be added, and that is insignificant for the purpose (maybe
@@ -271,54 +1834,71 @@ if __name__ == "__main__":
     obs = ap.Observer(location=loc, timezone=tz)
 
     # == Prepare catalog ================================================================= #
-    cat = pd.read_csv(TOP/"amastro_catalog_radec.csv", delimiter=',', comment="#")
-    if args.targets is not None:
-        cat = cat[cat["ID"].isin(args.targets)]
+    with span("catalog load"):
+        cat = load_catalog(TOP/"amastro_catalog_radec.csv", columns=CATCOLS,
+                           cache_dir=None if args.no_cache else cache_dir)
+        index = build_index(cat)
+
+    if args.serve is not None:
+        # == HTTP server ================================================================= #
+        defaults = dict(
+            lon=lon.value, lat=lat.value, tz=tz.zone, duration=args.duration,
+            min_alt=args.min_alt, always=args.always_visible, targets=args.targets,
+            messier=args.Messier, caldwell=args.Caldwell, types=args.types,
+            exclude=args.type_exclude, nickname=args.nickname, format=FORMAT
+        )
+        serve(args.host, args.serve, cat, index, defaults,
+              cache_dir=None if args.no_cache else cache_dir, figdir=FIGDIR,
+              verbose=args.verbose)
+        sys.exit()
+
+    with span("catalog selection"):
+        cat = select_catalog(cat, targets=args.targets, messier=args.Messier,
+                             caldwell=args.Caldwell, types=args.types,
+                             type_exclude=args.type_exclude, nickname=args.nickname,
+                             verbose=args.verbose)
+
+    if args.sites is not None:
+        # == Multiple sites ============================================================== #
+        sites = load_sites(args.sites)
+        with span("find visible (sites)"):
+            table = find_visible_sites(
+                cat, index, sites, OBSTIME, args.duration, args.min_alt,
+                always=args.always_visible, verbose=args.verbose
+            )
+        with span("table output"):
+            save_table(table, OUTPUT, FORMAT, escape=True)
         if args.verbose:
-            print(f"Choosing only thses: {args.targets}")
-    else:
-        if not args.Messier:
-            if args.verbose:
-                print("Messier objects are ignored.")
-            cat = cat[~cat["ID"].str.startswith("M")]
-        if not args.Caldwell:
-            if args.verbose:
-                print("Caldwell objects are ignored.")
-            cat = cat[~cat["ID"].str.startswith("C")]
-        if args.types is not None:
-            if args.type_exclude:
-                cat = cat[~cat["Type"].isin(args.types)]
-                if args.verbose:
-                    print(f"Following types will be ignored: {args.types}")
-            else:
-                cat = cat[cat["Type"].isin(args.types)]
-                if args.verbose:
-                    print(f"Only take the following types: {args.types}")
-
-        if args.nickname:
-            if args.verbose:
-                print("Only those with common nicknames are selected.")
-            cat = cat[cat["Name"].notna()]
-
-    if args.verbose:
-        print(f"{len(cat)} objects are selected by the user.")
-
-    cat.sort_values(by="DEC", ascending=False, ignore_index=True, inplace=True)
+            print(f"* Table of {len(sites)} sites saved to {OUTPUT}")
+        sys.exit()
+
+    if args.nights is not None:
+        # == Multi-night planner ========================================================= #
+        cat = cat[cat.index.isin(query_index(index, lat.value, args.min_alt))]
+        cat = cat.sort_values(by="DEC", ascending=False, ignore_index=True)
+        with span("plan nights"):
+            table = plan_nights(
+                cat, SkyCoord(ra=cat["RA"].values*u.deg, dec=cat["DEC"].values*u.deg), obs,
+                start=datetime.date(args.YYYY, args.MM, args.DD),
+                nights=args.nights,
+                min_alt=args.min_alt,
+                max_sun_alt=args.max_sun_alt
+            )
+        with span("table output"):
+            save_table(table, OUTPUT, FORMAT, escape=True)
+        if args.verbose:
+            print(f"{len(table)} (night, object) pairs are visible by the user's criteria.")
+            print(f"* Plan saved to {OUTPUT}")
+        sys.exit()
 
+    # == Find visible objects ============================================================ #
     # plotting order will anyway be based on Type.
-    coo = np.array(
-        [ap.FixedTarget(SkyCoord(ra=_a*u.deg, dec=_d*u.deg), name=f"{_id} ({_t})")
-         for _a, _d, _id, _t in zip(cat["RA"], cat["DEC"], cat["ID"], cat["Type"])]
-    )
-
-    # == Find coordinates of planets ===================================================== #
-    coo_pl = []
-    for planet in PLANETS.keys():
-        _coo = get_body(planet, time=OBSTIME, location=loc)
-        _coo.name = planet
-        coo_pl.append(_coo)
-    # RA/DEC only at the middle of the time.
-    coo_pl = np.array(coo_pl)
+    with span("find visible"):
+        cat_up, alt_range, alt, xyz_pl = find_visible(
+            cat, index, obs, OBSTIME, args.duration, args.min_alt, always=args.always_visible,
+            cache_dir=None if args.no_cache else cache_dir, planets=not args.no_plot,
+            verbose=args.verbose
+        )
 
     # style_ini = dict(style_kwargs=dict(marker=".", color="r"))
     # style_mid = dict(style_kwargs=dict(marker="x", color="r"))
@@ -335,139 +1915,141 @@ if __name__ == "__main__":
     #               if np.any(observer.target_is_up(times, _coo, horizon=horizon))]
     #     return coo_up
 
+    # == Scores ========================================================================== #
+    scores = None
+    if args.rank or args.min_score is not None:
+        with span("scores"):
+            _, alltimes = time_grid(OBSTIME, args.duration)
+            scores, _ = score_targets(cat_up, np.hstack([alt_range, alt]),
+                                      moon_track(obs, alltimes), args.min_alt, now=1,
+                                      dark=args.sky_mag)
+        if args.min_score is not None:
+            _mask = (scores["Score"] >= args.min_score).to_numpy()
+            cat_up = cat_up[_mask].reset_index(drop=True)
+            alt_range, alt = alt_range[_mask], alt[_mask]
+            scores = scores[_mask].reset_index(drop=True)
+            if args.verbose:
+                print(f"{np.sum(_mask)} objects have the score above {args.min_score}.")
+
+    if args.snapshots is not None or args.animate is not None:
+        # == Frames over the night ======================================================= #
+        def _frames():
+            return sky_frames(cat_up, obs, OBSTIME, args.duration, step=args.frame_step,
+                              cache_dir=None if args.no_cache else cache_dir)
+
+        if args.snapshots is not None:
+            with span("snapshots"), open(args.snapshots, "w") as output:
+                write_snapshots(_frames(), output, cat_up["ID"], tz)
+            if args.verbose:
+                print(f"* Snapshots saved to {args.snapshots}")
+        if args.animate is not None:
+            with span("animation"):
+                save_animation(_frames(), args.animate, cat_up["ID"], tz, min_alt=args.min_alt)
+            if args.verbose:
+                print(f"* Animation saved to {args.animate}")
+        sys.exit()
+
+    if args.schedule:
+        # == Observing sequence ========================================================== #
+        with span("schedule"):
+            table = schedule_night(cat_up, obs, OBSTIME, args.duration, args.min_alt,
+                                   dwell=args.dwell, slew_rate=args.slew_rate,
+                                   settle=args.settle, slew_cost=args.slew_cost,
+                                   cache_dir=None if args.no_cache else cache_dir)
+        with span("table output"):
+            save_table(table, OUTPUT, FORMAT, escape=True)
+        if args.verbose:
+            print(f"{len(table)} objects are scheduled.")
+            print(f"* Sequence saved to {OUTPUT}")
+        sys.exit()
+
+    # == Save the table ================================================================== #
+    colnames = alt_colnames(datetime.datetime(args.YYYY, args.MM, args.DD, args.HH, args.mm),
+                            args.duration)
+    with span("table output"):
+        head, sprites = "", None
+        if args.self_contained and FORMAT == "html":
+            if (FIGDIR/"sprites"/"index.json").exists():
+                head, sprites = embed_sprites(
+                    FIGDIR/"sprites", np.concatenate(list(image_stems(cat_up["ID"]).values()))
+                )
+            else:
+                print("No sprite sheets in figs/sprites (see `onetime_downloader.py -p`); "
+                      + "the images are linked.")
+        table = make_table(cat_up, alt_range, fmt=FORMAT, min_alt=args.min_alt,
+                           colnames=colnames, figdir=FIGDIR, scores=scores, rank=args.rank,
+                           sprites=sprites)
+        save_table(table, OUTPUT, FORMAT, head=head)
+    if args.verbose:
+        print(f"* Catalog saved to {OUTPUT}")
+
+    if args.no_plot:
+        sys.exit()
+
     # == Set plotting style ============================================================== #
-    observable_kw = dict(observer=obs, times=OBSTIMES, always=args.always_visible)
-    upmask = check_observable(args.min_alt, targets=coo, **observable_kw)
-    coo_up = coo[upmask]
-    cat_up = cat[upmask]
+    with span("plot setup (imports)"):
+        plt = setup_plot()
 
     fullmask = np.ones(len(cat_up))
     for typ, kwdict in PLOTKW.items():
         typmask = cat_up["Type"].str.startswith(typ)
-        add2kw(kwdict, cat_up, coo_up, typmask, plt.cm.viridis)
+        add2kw(kwdict, cat_up, alt, typmask, plt.cm.viridis)
         fullmask -= typmask
-    add2kw(PLOTKW_OTHERS, cat_up, coo_up, fullmask.astype(bool), plt.cm.viridis)
+    add2kw(PLOTKW_OTHERS, cat_up, alt, fullmask.astype(bool), plt.cm.viridis)
     PLOTKW["others"] = PLOTKW_OTHERS
 
-    cat_up["lowres"] = cat_up["ID"].apply(
-        lambda x: f'<img src="{FIGDIR}/{parseID(x)}_{int(x[1:]):03d}.jpg">'
-    )
-    cat_up["DSS"] = cat_up["ID"].apply(
-        lambda x: f'<img src="{FIGDIR}/DSS-200px-{x}.jpg" width=200px>'
-    )
-    cat_up["DSS-zscale"] = cat_up["ID"].apply(
-        lambda x: f'<img src="{FIGDIR}/DSS-200px-{x}-zscale.jpg" width=200px>'
-    )
-    if args.verbose:
-        print(f"{len(cat_up)} objects are visible by the user's criteria.")
-
-    # == Plot ============================================================================ #
-    fig, axs = plt.subplots(1, 1, figsize=(9, 9))
-    alts_beg = []
-    alts_mid = []
-    alts_end = []
-
-    for typ, kw in PLOTKW.items():
-        for _coo, _color in zip(kw["coo"], kw["colors"]):
-            aplt.plot_altitude(
-                ax=axs,
-                targets=_coo,
-                observer=obs,
-                time=OBSTIMES,
-                min_altitude=args.min_alt,
-                style_kwargs=dict(
-                    linestyle=kw["ls"],
-                    color=_color,
-                    alpha=kw["alpha"],
-                    linewidth=kw["lw"]
-                )
-            )
-            alts = obs.altaz(OBSTIME_RANGE, target=_coo).alt
-            alts_beg.append(alts[0].value)
-            alts_mid.append(alts[1].value)
-            alts_end.append(alts[2].value)
-
-        if args.verbose:
-            print(f"{typ:>6s}: {len(kw['coo']):02d} objects")
-
-    _radec = cat_up["RA"].astype(str) + "<br>" + cat_up["DEC"].astype(str)
-    cat_up.sort_values(by=["Type", "DEC"], ascending=False, ignore_index=True, inplace=True)
-    cat_up.insert(loc=3, column="RADEC[˚]", value=_radec.values)
-    cat_up["ID"] = cat_up["ID"].apply(mk_wikilink)  # Add wiki links.
-    cat_up["ID"] = "<b>" + cat_up["ID"] + "</b><br><br>" + cat_up["Other ID"]
-
-    colnames = [
-        f"- {dt.value:.0f} hr<br>altitude",
-        (f"{str(args.YYYY)[-2:]}-{args.MM:02d}-{args.DD:02d}<br>"
-         + f"{args.HH:02d}:{args.mm:02d}<br>altitude"),
-        f"+ {dt.value:.0f} hr<br>altitude"
-    ]
-    for i, (alts, col) in enumerate(zip([alts_beg, alts_mid, alts_end], colnames)):
-        cat_up.insert(loc=i+3, column=col, value=alts)
-        cat_up[col] = cat_up[col].apply(alt_color)
-
-    cat_up.drop(columns=COLS2DROP, inplace=True)
+    # == Ephemeris ======================================================================= #
+    with span("ephemeris"):
+        moon_phase = obs.moon_phase(OBSTIME).to(u.deg).value
+        # in radian, phase=pi is “new”, phase=0 is “full”.
+        alt_moon = obs.moon_altaz(OBSTIMES).alt
+
+        names_pl = np.array(list(PLANETS.keys()))
+        if xyz_pl is None:
+            # RA/DEC only at the middle of the time.
+            coo_pl = SkyCoord([get_body(planet, time=OBSTIME, location=loc)
+                               for planet in PLANETS])
+            alt_pl, _ = altaz_matrix(obs, coo_pl, OBSTIMES)
+        else:
+            alt_pl, _ = xyz2alt(xyz_pl)
+        upmask_pl = check_observable(args.min_alt_pl, alt_pl, args.always_visible)
 
-    # == Convert to HTML ================================================================= #
-    html_str = cat_up.to_html(None, index=False, escape=False)
-    html_str = "<pre>" + html_str + "</pre>"
-    with open(OUTPUT, "w+") as output:
-        output.write(html_str)
+        # For the twilight shading: the altitude of the Sun, once per minute.
+        times_sun = OBSTIME + np.linspace(-1, 1, int(args.duration*120) + 1)*args.duration*u.hour
+        alt_sun = obs.sun_altaz(times_sun).alt.deg
 
     if args.verbose:
-        print(f"* Catalog saved to {OUTPUT}")
-    # ------------------------------------------------------------------------------------ #
-
-    # for i, (_coo, ls) in enumerate(zip(coo_up, lss)):
-    #     aplt.plot_altitude(
-    #         targets=_coo, observer=obs, time=OBSTIMES, ax=axs, min_altitude=args.min_alt,
-    #         style_kwargs=dict(linestyle=ls, color=colors[i], alpha=0.7, linewidth=2)
-    #     )
-
-    moon_phase = obs.moon_phase(OBSTIME).to(u.deg).value
-    # in radian, phase=pi is “new”, phase=0 is “full”.
-    alt_moon = obs.moon_altaz(OBSTIMES).alt
-    axs.plot_date(OBSTIMES.plot_date, alt_moon, '-', color='k', linewidth=6, alpha=0.4,
-                  label=f'Moon (θ_full={moon_phase:.0f}˚)')
-
-    upmask_pl = check_observable(args.min_alt_pl, targets=coo_pl, **observable_kw)
-    coo_pl_up = coo_pl[upmask_pl]
-    if args.verbose:
-        print(f"{len(coo_pl_up)} planets are visible under the user's criteria.")
+        print(f"{np.sum(upmask_pl)} planets are visible under the user's criteria.")
         print(INFOSTR)
 
-    if len(coo_pl_up) > 0:
-        for _coo in coo_pl_up:
-            aplt.plot_altitude(
-                ax=axs,
-                targets=_coo,
-                observer=obs,
-                time=OBSTIMES,
-                min_altitude=args.min_alt,
-                style_kwargs=dict(
-                    color=PLANETS[_coo.name],
-                    linewidth=6,
-                    alpha=0.3
-                )
-            )
+    # == Plot ============================================================================ #
+    # All the altitudes are precomputed: one LineCollection is drawn per style.
+    with span("plot"):
+        fig, axs = plt.subplots(1, 1, figsize=(9, 9))
+        x = OBSTIMES.plot_date
+        handles = []
+
+        for typ, kw in PLOTKW.items():
+            labels = [f"{_id} ({_t})" for _id, _t in zip(kw["df"]["ID"], kw["df"]["Type"])]
+            handles += plot_curves(axs, x, kw["alt"], args.min_alt, kw["colors"], labels,
+                                   ls=kw["ls"], lw=kw["lw"], alpha=kw["alpha"])
 
-    fake_coo = coo_pl[0].copy()
-    fake_coo.name = None
-    aplt.plot_altitude(
-        ax=axs,
-        targets=fake_coo,
-        observer=obs,
-        time=OBSTIMES,
-        min_altitude=args.min_alt,
-        airmass_yaxis=True,
-        brightness_shading=True,
-        style_kwargs=dict(linestyle='')
-    )
-
-    axs.axhline(30, color='k', linestyle='-')
-    axs.legend(ncol=4, bbox_to_anchor=(0.5, -0.15), loc=9,
-               prop={"family": "monospace", "size": 10},
-               title="<Catalog ID> (<Type>). Use `-v` for detailed explanation for Type.")
-    plt.tight_layout()
+            if args.verbose:
+                print(f"{typ:>6s}: {len(kw['df']):02d} objects")
+
+        handles += axs.plot(x, alt_moon, '-', color='k', linewidth=6, alpha=0.4,
+                            label=f'Moon (θ_full={moon_phase:.0f}˚)')
+        handles += plot_curves(axs, x, alt_pl[upmask_pl], args.min_alt,
+                               [PLANETS[_name] for _name in names_pl[upmask_pl]],
+                               names_pl[upmask_pl], lw=6, alpha=0.3)
+
+        plot_twilight(axs, times_sun.plot_date, alt_sun)
+        format_altitude_axes(axs, x, args.min_alt)
+
+        axs.axhline(30, color='k', linestyle='-')
+        axs.legend(handles=handles, ncol=4, bbox_to_anchor=(0.5, -0.15), loc=9,
+                   prop={"family": "monospace", "size": 10},
+                   title="<Catalog ID> (<Type>). Use `-v` for detailed explanation for Type.")
+        plt.tight_layout()
     plt.show()
 
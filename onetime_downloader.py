@@ -1,16 +1,32 @@
+import argparse
+import atexit
+import contextlib
+import hashlib
+import json
+import multiprocessing
+import os
 import re
-import urllib.request
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
-from time import sleep
+from urllib.parse import urljoin, urlsplit
 
-import astroplan as ap
+import matplotlib
 import numpy as np
 import pandas as pd
 import requests
 from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
 from astropy.wcs import WCS
+from astroquery.simbad import Simbad
 from astroquery.skyview import SkyView
 from bs4 import BeautifulSoup
+from PIL import Image
+matplotlib.use("Agg")  # Only files are saved; also safe in the rendering processes.
 from matplotlib import pyplot as plt
 from matplotlib import rcParams
 from photutils import SkyRectangularAperture
@@ -28,124 +44,554 @@ rcParams.update({
     'xtick.minor.visible': True, 'ytick.minor.visible': True
 })
 
+TOP = Path(__file__).parent
 
-# Directory to save image files
-SAVEDIR = Path("figs/")
-SAVEDIR.mkdir(exist_ok=True)
+# The DSS cutouts: field size [arcmin] and number of pixels along each side.
+DSS_FOV = 35
+DSS_PIXELS = 200
 
+# Rendered variants of the finder charts: file name suffix and `yvu.norm_imshow` keywords.
+# All of them are made from a single download of the DSS image.
+FINDER_VARIANTS = {
+    "": {"origin": "lower", "cmap": "viridis", "zscale": False},
+    "-zscale": {"origin": "lower", "cmap": "viridis", "zscale": True},
+}
+
+# Bump this when `save_finder_plot` changes, so that all the charts are rendered again.
+FINDER_STYLE_VERSION = 1
+
+# Wikipedia pages of the thumbnails: (file name prefix, page, index of the wikitable)
+WIKI_PAGES = [
+    ("Messier", "wiki/Messier_object", 0),
+    ("Caldwell", "wiki/Caldwell_catalogue", 1),
+]
+
+# Sprite sheets of the images of the report (`pack_sprites`), one per kind: size of the tile
+# [px] (the images are shrunk to fit in it), number of tiles per row, and JPEG quality.
+SPRITE_TILES = {"lowres": (70, 70), "DSS": (200, 200), "DSS-zscale": (200, 200)}
+SPRITE_COLUMNS = 16
+SPRITE_QUALITY = 80
+SPRITE_VERSION = 1
+
+# The manifest is saved after this many updates or seconds (and at exit), not after each one.
+MANIFEST_FLUSH_EVERY = 100
+MANIFEST_FLUSH_INTERVAL = 5.  # [s]
+
+p = argparse.ArgumentParser(
+    description="Resolve the coordinates of the catalog objects and download their images."
+)
+p.add_argument("-s", "--savedir", default=TOP/"figs", type=Path,
+               help="Directory to save image files (and the download manifest)")
+p.add_argument("-c", "--cutouts", default=TOP/"cutouts", type=Path,
+               help="Directory of the local store of the FITS cutouts")
+p.add_argument("-r", "--rerender", action="store_true",
+               help="Render all the finder charts again (from the local cutouts if available)")
+p.add_argument("-w", "--workers", default=4, type=int,
+               help="Number of concurrent downloads")
+p.add_argument("-j", "--jobs", default=os.cpu_count(), type=int,
+               help="Number of processes to render the finder charts")
+p.add_argument("-i", "--interval", default=0.8, type=float,
+               help="Minimum interval between two requests to the same host [s]")
+p.add_argument("--wiki-url", default="https://en.wikipedia.org/",
+               help="Base URL of Wikipedia (e.g., a local stand-in server for testing)")
+p.add_argument("--skyview-url", default=None,
+               help="URL of the SkyView query page (default: that of astroquery)")
+p.add_argument("--simbad-server", default=None,
+               help="Host of SIMBAD for the names not in the local tables (default: that of astroquery)")
+p.add_argument("-t", "--tables", default=[TOP/"amastro_catalog_radec.csv"], nargs='+', type=Path,
+               help=("Local tables of coordinates looked up before SIMBAD: CSV files with ID, RA, DEC"
+                     " [deg] and optionally Other ID (' & '-separated) columns"))
+p.add_argument("--offline", action="store_true",
+               help="Resolve the names only from the local tables (no SIMBAD query)")
+p.add_argument("-p", "--pack-only", action="store_true",
+               help=("Only pack the images already in --savedir into the sprite sheets of the report"
+                     " (no query or download)"))
+p.add_argument("-q", "--sprite-quality", default=SPRITE_QUALITY, type=int,
+               help="JPEG quality of the sprite sheets")
+
+
+class RateLimiter:
+    ''' Keep at least `interval` seconds between the requests to the same host.
+    Thread-safe; requests to different hosts do not wait for each other.
+    '''
+    def __init__(self, interval):
+        self.interval = interval
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def wait(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next.get(host, now))
+            self._next[host] = start + self.interval
+        time.sleep(start - now)
+
+
+class Manifest:
+    ''' Record of finished work, saved as a JSON file every `flush_every` updates or
+    `flush_interval` seconds and at exit, so that an interrupted run resumes where it stopped
+    (at most the last few updates are done again). Thread-safe.
+    '''
+    def __init__(self, path, flush_every=MANIFEST_FLUSH_EVERY,
+                 flush_interval=MANIFEST_FLUSH_INTERVAL):
+        self.path = Path(path)
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._flushed_at = time.monotonic()
+        try:
+            with open(self.path) as manifest:
+                self.data = json.load(manifest)
+        except (OSError, ValueError):
+            self.data = {}
+        atexit.register(self.flush)
+
+    def get(self, section, key, default=None):
+        with self._lock:
+            return self.data.get(section, {}).get(key, default)
+
+    def set(self, section, key, value):
+        with self._lock:
+            self.data.setdefault(section, {})[key] = value
+            self._pending += 1
+            if (self._pending >= self.flush_every
+                    or time.monotonic() - self._flushed_at >= self.flush_interval):
+                self._save()
+
+    def flush(self):
+        ''' Save the pending updates now. '''
+        with self._lock:
+            if self._pending:
+                self._save()
+
+    def _save(self):
+        tmppath = self.path.with_suffix(".tmp")
+        with open(tmppath, "w") as manifest:
+            json.dump(self.data, manifest, indent=1)
+        os.replace(tmppath, self.path)
+        self._pending = 0
+        self._flushed_at = time.monotonic()
+
+
+def content_hash(*items):
+    ''' Short hash of `items` (the inputs of an artifact), to tell whether it is up to date.
+    '''
+    return hashlib.sha1(json.dumps(items, default=str).encode()).hexdigest()[:16]
+
+
+def normalize_name(name):
+    ''' "NGC 1952", "ngc1952" -> "NGC1952" '''
+    return re.sub(r"\s+", "", name).upper()
+
+
+def load_resolver_table(paths, exclude=()):
+    ''' The local lookup table of coordinates, ``{normalized name: (ra, dec)}``, from CSV files
+    (e.g., `amastro_catalog_radec.csv` made by the previous run). Missing files are ignored, and
+    so are the rows whose ID is in `exclude` (the rows whose Other ID was edited: their
+    coordinates in such a table are those of the old Other ID).
+    '''
+    table = {}
+    exclude = set(exclude)
+    for path in paths:
+        if not Path(path).exists():
+            continue
+        tab = pd.read_csv(path, delimiter=',')
+        othids = tab["Other ID"] if "Other ID" in tab else [np.nan]*len(tab)
+        for catid, othid, ra, dec in zip(tab["ID"], othids, tab["RA"], tab["DEC"]):
+            if np.isnan(ra) or np.isnan(dec) or catid in exclude:
+                continue
+            names = [catid] + (othid.split(" & ") if isinstance(othid, str) else [])
+            for name in names:
+                table.setdefault(normalize_name(name), (float(ra), float(dec)))
+    return table
+
+
+def resolve_batch(names, table, limiter, offline=False):
+    ''' Resolve the coordinates of many objects at once.
+
+    Parameters
+    ----------
+    names : dict
+        ``{catid: [names to try in order]}``.
+    table : dict
+        The local lookup table (see `load_resolver_table`), consulted first.
+    offline : bool
+        If `True`, SIMBAD is not queried for the names missing in `table`.
+
+    Returns
+    -------
+    found : dict
+        ``{catid: (ra, dec, name, source)}``, where `name` is the identifier that succeeded and
+        `source` is ``"local"`` or ``"simbad"``. Unresolved objects are not included.
+    '''
+    found = {}
+    for catid, cands in names.items():
+        for name in cands:
+            if normalize_name(name) in table:
+                found[catid] = (*table[normalize_name(name)], name, "local")
+                break
+    if offline:
+        return found
+
+    # One query for all the first names of the misses, then one for the second names, ...
+    for i in range(max(map(len, names.values()), default=0)):
+        batch = {catid: cands[i] for catid, cands in names.items()
+                 if catid not in found and len(cands) > i}
+        if not batch:
+            continue
+        limiter.wait(f"https://{Simbad.server}")
+        result = Simbad.query_objects(list(batch.values()))
+        coos = {}
+        for res in result:
+            if not np.ma.is_masked(res["ra"]) and not np.ma.is_masked(res["dec"]):
+                coos[res["user_specified_id"]] = (float(res["ra"]), float(res["dec"]))
+        for catid, name in batch.items():
+            if name in coos:
+                found[catid] = (*coos[name], name, "simbad")
+    return found
+
+
+def resolve_catalog(rows, manifest, tables, limiter, offline=False):
+    ''' Resolve the coordinates of the catalog rows whose ID or Other ID changed (or are new),
+    looking them up in the local `tables` (paths of CSV files; see `load_resolver_table`) before
+    SIMBAD, and record them in the manifest. Returns the IDs which could not be resolved.
+    '''
+    names, hashes, edited = {}, {}, []
+    for catid, row in rows.items():
+        othid = row["Other ID"]
+        if not isinstance(othid, float):  # if it was a float, it means it was a NaN.
+            othid = othid.split(" & ")[0]
+        hashes[catid] = content_hash(catid, othid)
+        coo = manifest.get("coords", catid)
+        if coo is None or coo.get("hash") != hashes[catid]:
+            names[catid] = [catid] + ([othid] if isinstance(othid, str) else [])
+            if coo is not None:  # resolved before from another ID/Other ID
+                edited.append(catid)
+
+    table = load_resolver_table(tables, exclude=edited)
+    found = resolve_batch(names, table, limiter, offline=offline)
+    for catid, (ra, dec, name, source) in found.items():
+        manifest.set("coords", catid, dict(ra=ra, dec=dec, name=name, source=source,
+                                           hash=hashes[catid]))
+    return [catid for catid in names if catid not in found]
+
+
+def cutout_path(store, catid, survey="DSS", fov=DSS_FOV):
+    ''' Path of the cutout of `catid` in the local store: `<store>/<survey>/<fov>arcmin/<catid>.fits`
+    '''
+    return Path(store)/survey/f"{fov:g}arcmin"/f"{catid}.fits"
+
+
+def fetch_dss(obj_coord, savepath, limiter):
+    ''' Download the DSS image around `obj_coord` to the cutout store (once for all the
+    variants). The data is saved unscaled so that `load_cutout` can memory-map it.
+    '''
+    limiter.wait(SkyView.URL)
+    hdu = SkyView.get_images(obj_coord, survey='DSS', width=DSS_FOV*u.arcmin,
+                             height=DSS_FOV*u.arcmin, coordinates="ICRS", projection="Tan",
+                             pixels=DSS_PIXELS, scaling="Linear", sampler="NN", resolver=None,
+                             deedger=None, lut=None, grid=None, gridlabels=None, radius=None,
+                             cache=False, show_progress=False)[0][0]
+    header = hdu.header.copy()
+    for key in ["BSCALE", "BZERO", "BLANK"]:
+        header.remove(key, ignore_missing=True)
+    savepath.parent.mkdir(exist_ok=True, parents=True)
+    tmppath = savepath.with_suffix(".part")
+    fits.PrimaryHDU(np.asarray(hdu.data, dtype=np.float32), header=header).writeto(
+        tmppath, overwrite=True
+    )
+    os.replace(tmppath, savepath)
+    return savepath
+
+
+@contextlib.contextmanager
+def load_cutout(path):
+    ''' The cutout HDU with its data memory-mapped from the store (nothing is read until used).
+    The file is closed at the end of the block, so long-lived workers do not keep it open.
+    '''
+    with fits.open(path, memmap=True) as hdul:
+        yield hdul[0]
+
+
+def finder_template():
+    ''' The figure and WCS axes reused for all the finder charts drawn by this process.
+    Only the WCS, image, title and aperture change from chart to chart.
+    '''
+    global _TEMPLATE
+    if _TEMPLATE is None:
+        fig = plt.figure(figsize=(3.5, 3.5))
+        ax = plt.subplot(projection=WCS(naxis=2))
+        ax.text(0.2, 0.15, "21'×21'", transform=ax.transAxes,
+                fontsize=12, fontfamily="monospace", fontweight="bold", color="r")
+        _TEMPLATE = fig, ax
+    return _TEMPLATE
+
+
+_TEMPLATE = None
+
+
+def save_finder_plot(savepath, longname, obj_coord, hdu, plotkw={}):
+    fig, ax = finder_template()
+    for artist in [*ax.images, *ax.patches]:  # of the previous chart
+        artist.remove()
 
-def save_finder_plot(savepath, longname, obj_coord, plotkw={}):
-    if savepath.exists():
-        return
-    hdu = SkyView.get_images(_coo.coord, survey='DSS', width=35*u.arcmin, height=35*u.arcmin,
-                             coordinates="ICRS", projection="Tan", pixels=200, scaling="Linear",
-                             sampler="NN", resolver=None, deedger=None, lut=None, grid=None, gridlabels=None,
-                             radius=None, cache=True, show_progress=True)[0][0]
     wcs = WCS(hdu.header)
     fov = SkyRectangularAperture(obj_coord, w=21*u.arcmin, h=21*u.arcmin).to_pixel(wcs)
-
-    fig = plt.figure(figsize=(3.5, 3.5))
-    ax = plt.subplot(projection=wcs)
+    ax.reset_wcs(wcs)
     yvu.norm_imshow(ax, hdu.data, **plotkw)
     ax.set_xlabel(r"$\longleftarrow \mathrm{RA}\ (\alpha)$", fontsize=12)
     ax.set_ylabel(r"$\mathrm{DEC}\ (\delta) \longrightarrow$", fontsize=12)
     ax.set_title(longname)
 
-    fov.plot(ax, color='red')
-    ax.text(0.2, 0.15, "21'×21'", transform=ax.transAxes,
-            fontsize=12, fontfamily="monospace", fontweight="bold", color="r")
+    fov.plot(ax=ax, color='red')
     ax.tick_params(direction="out", fontfamily="monospace")
     ax.coords[0].set_axislabel(r"$\longleftarrow \mathrm{RA}\ (\alpha)$", minpad=0.5, fontsize=12)
     ax.coords[1].set_axislabel(r"$\mathrm{DEC}\ (\delta) \longrightarrow$", minpad=0.5, fontsize=12)
 
     # plt.tight_layout()
-    plt.savefig(savepath, bbox_inches="tight")
-    plt.cla()
-    plt.close()
+    fig.savefig(savepath, bbox_inches="tight")
     return
 
 
-# %%
-# ********************************************************************************************************** #
-# *                                         QUERY RA/DEC OF OBJECTS                                        * #
-# ********************************************************************************************************** #
-cat = pd.read_csv(Path(__file__).parent/"amastro_catalog.csv", delimiter=',')
-coo = []
-# Once it is done, the info will be cached to the astropy cache directory.
-# You may clean it by astropy.utils.clear_download_cache()
-# See https://docs.astropy.org/en/stable/utils/index.html
-for _, row in cat.iterrows():
-    catid = row['ID']
+def render_finders(savepaths, longname, ra, dec, cutout):
+    ''' Render the variants of a finder chart from one cutout in the store (run in a worker
+    process). `savepaths` maps the suffix in `FINDER_VARIANTS` to the path to save.
+    '''
+    obj_coord = SkyCoord(ra*u.deg, dec*u.deg)
+    with load_cutout(cutout) as hdu:
+        for suffix, savepath in savepaths.items():
+            save_finder_plot(savepath, longname, obj_coord, hdu, plotkw=FINDER_VARIANTS[suffix])
+    return savepaths
+
+
+def finder_paths(savedir, catid):
+    return {suffix: savedir/f"DSS-200px-{catid}{suffix}.jpg" for suffix in FINDER_VARIANTS}
+
+
+def finder_title(row):
     othid = row["Other ID"]
-    name = row["Name"]
-    typekey = row["Type"]
     if not isinstance(othid, float):  # if it was a float, it means it was a NaN.
         othid = othid.split(" & ")[0]
+    longname = f"{row['ID']} ({othid}, {row['Type']})"
+    longname += f"\n{row['Name']}" if isinstance(row['Name'], str) else ""
+    return longname
+
+
+def query_object(row, savedir, store, manifest, limiter, rerender=False):
+    ''' Bring the cutout and finder charts of a catalog row up to date (its coordinate must
+    have been resolved by `resolve_catalog`).
+
+    Each artifact is recorded in the manifest with the hash of its inputs: the cutout is
+    downloaded again only if the coordinate changed, and a chart is stale if its title (ID,
+    Other ID, Type, Name), cutout or rendering parameters changed.
+
+    Returns
+    -------
+    catid : str
+    coord : SkyCoord
+    charts : dict
+        The charts to render, ``{suffix: (savepath, hash)}``.
+    '''
+    catid = row['ID']
+    coo = manifest.get("coords", catid)
+    coord = SkyCoord(coo["ra"]*u.deg, coo["dec"]*u.deg)
+
+    cutout = cutout_path(store, catid)
+    cut_hash = content_hash(coo["ra"], coo["dec"], DSS_FOV, DSS_PIXELS)
+    longname = finder_title(row)
+    charts = {}
+    for suffix, savepath in finder_paths(savedir, catid).items():
+        chart_hash = content_hash(longname, cut_hash, FINDER_VARIANTS[suffix],
+                                  FINDER_STYLE_VERSION)
+        if (rerender or not savepath.exists()
+                or manifest.get("charts", savepath.name) != chart_hash):
+            charts[suffix] = (savepath, chart_hash)
+
+    if charts and (not cutout.exists() or manifest.get("cutouts", catid) != cut_hash):
+        fetch_dss(coord, cutout, limiter)
+        manifest.set("cutouts", catid, cut_hash)
+    return catid, coord, charts
+
+
+def wiki_thumbnail_urls(wiki_url, page, table_index, session):
+    ''' URLs of the images in the `table_index`-th wikitable of the Wikipedia `page`.
+    '''
+    r = session.get(wiki_url + page)
+    r.raise_for_status()
+    soup = BeautifulSoup(r.text, 'html.parser')
+    table = soup.find_all(class_='wikitable')[table_index]
+    imgs = table.find_all(class_="image")
+    # The `src` are protocol-relative ("//upload.wikimedia.org/..."): follow the scheme of `wiki_url`.
+    return [urljoin(wiki_url, re.split(r"src=", str(img))[1][1:].split('"')[0]) for img in imgs]
+
+
+def download(url, savepath, session, limiter):
+    ''' Download `url` to `savepath` (through a temporary file, so no partial file is left).
+    '''
+    limiter.wait(url)
+    r = session.get(url)
+    r.raise_for_status()
+    tmppath = savepath.with_suffix(".part")
+    tmppath.write_bytes(r.content)
+    os.replace(tmppath, savepath)
+    return url
+
+
+def sprite_kind(name):
+    ''' Kind (sprite sheet) of an image of `savedir` by its file name.
+    '''
+    if name.startswith("DSS-"):
+        return "DSS-zscale" if name.endswith("-zscale.jpg") else "DSS"
+    return "lowres"
+
+
+def pack_sprites(savedir, manifest, quality=SPRITE_QUALITY):
+    ''' Pack the JPEG images of `savedir` into one sprite sheet per kind (`SPRITE_TILES`) in
+    ``savedir/sprites``, with ``index.json``: ``{"sheets": {kind: {"file", "tile",
+    "columns", "quality"}}, "images": {stem: [kind, slot, width, height]}}``.
+
+    The images are shrunk to fit in the tiles and re-encoded; identical images (by content)
+    share one tile. Nothing is done if the images and the settings are the same as the last
+    time (recorded in `manifest`).
+    '''
+    outdir = Path(savedir)/"sprites"
+    paths = sorted(Path(savedir).glob("*.jpg"))
+    stamp = content_hash(SPRITE_VERSION, SPRITE_TILES, SPRITE_COLUMNS, quality,
+                         [(path.name, path.stat().st_size, path.stat().st_mtime_ns) for path in paths])
+    if manifest.get("sprites", "stamp") == stamp and (outdir/"index.json").exists():
+        return
+
+    tmpdir = outdir.with_name(f"sprites.{os.getpid()}.tmp")
+    tmpdir.mkdir(parents=True, exist_ok=True)
+    index = dict(sheets={}, images={})
+    for kind, (tw, th) in SPRITE_TILES.items():
+        tiles, slots = [], {}  # slots: content hash -> slot
+        for path in paths:
+            if sprite_kind(path.name) != kind:
+                continue
+            data = path.read_bytes()
+            key = hashlib.sha1(data).hexdigest()
+            if key not in slots:
+                with Image.open(path) as img:
+                    img = img.convert("RGB")
+                    img.thumbnail((tw, th), Image.LANCZOS)
+                slots[key] = len(tiles)
+                tiles.append(img)
+            img = tiles[slots[key]]
+            index["images"][path.stem] = [kind, slots[key], img.width, img.height]
+        if not tiles:
+            continue
+        ncol = min(len(tiles), SPRITE_COLUMNS)
+        sheet = Image.new("RGB", (ncol*tw, -(-len(tiles)//ncol)*th), "white")
+        for i, img in enumerate(tiles):
+            sheet.paste(img, ((i % ncol)*tw, (i//ncol)*th))
+        sheet.save(tmpdir/f"{kind}.jpg", "JPEG", quality=quality, optimize=True, progressive=True)
+        index["sheets"][kind] = dict(file=f"{kind}.jpg", tile=[tw, th], columns=ncol,
+                                     quality=quality)
+        print(f"sprites/{kind}.jpg: {len(tiles)} tiles ({len(paths)} files scanned)")
+    with open(tmpdir/"index.json", "w") as idx:
+        json.dump(index, idx, indent=1)
+    shutil.rmtree(outdir, ignore_errors=True)
+    os.replace(tmpdir, outdir)
+    manifest.set("sprites", "stamp", stamp)
+
+
+if __name__ == "__main__":
+    args = p.parse_args()
+    if args.skyview_url is not None:
+        SkyView.URL = args.skyview_url
+    if args.simbad_server is not None:
+        Simbad.server = args.simbad_server
+
+    # Directory to save image files
+    SAVEDIR = args.savedir
+    SAVEDIR.mkdir(exist_ok=True, parents=True)
+    manifest = Manifest(SAVEDIR/"manifest.json")
+    limiter = RateLimiter(args.interval)
+    session = requests.Session()
+    session.headers["User-Agent"] = "amateur_astro_cat (onetime_downloader.py)"
+    if args.pack_only:
+        pack_sprites(SAVEDIR, manifest, quality=args.sprite_quality)
+        sys.exit()
+
+    # %%
+    # ****************************************************************************************************** #
+    # *                                       QUERY RA/DEC OF OBJECTS                                      * #
+    # ****************************************************************************************************** #
+    cat = pd.read_csv(TOP/"amastro_catalog.csv", delimiter=',')
+    # The DSS images are kept in the cutout store (`-c`), so re-rendering the charts with other
+    # styles does not download them again.
+    rows = {row["ID"]: row for _, row in cat.iterrows()}
+    # The names are looked up in the local tables first; only the misses are sent to SIMBAD,
+    # all in one query.
+    unresolved = resolve_catalog(rows, manifest, args.tables, limiter, offline=args.offline)
+    for catid in unresolved:
+        print(f"Unable to find coordinates for {catid}; skipped.")
+        rows.pop(catid)
+        if manifest.get("coords", catid) is not None:  # stale, from the previous ID/Other ID
+            manifest.set("coords", catid, None)
+
+    # Downloads run in threads; the charts are rendered in processes as the images arrive.
+    # The processes are spawned, not forked: forking while the download threads hold locks
+    # (of the manifest, the connection pools, ...) can deadlock the children.
+    with ThreadPoolExecutor(max_workers=args.workers) as pool, \
+            ProcessPoolExecutor(max_workers=args.jobs,
+                                mp_context=multiprocessing.get_context("spawn")) as renderers:
+        futures = [pool.submit(query_object, row, SAVEDIR, args.cutouts, manifest, limiter,
+                               rerender=args.rerender)
+                   for row in rows.values()]
+        renders = {}
+        for future in as_completed(futures):
+            catid, coord, charts = future.result()
+            if not charts:
+                continue
+            savepaths = {suffix: savepath for suffix, (savepath, _) in charts.items()}
+            renders[renderers.submit(render_finders, savepaths, finder_title(rows[catid]),
+                                     coord.ra.deg, coord.dec.deg,
+                                     cutout_path(args.cutouts, catid))] = charts
+        for future in as_completed(renders):
+            future.result()
+            for savepath, chart_hash in renders[future].values():
+                manifest.set("charts", savepath.name, chart_hash)
+                print(savepath.name)
+
+    # Artifacts of the rows removed from the catalog (not deleted, just reported).
+    for catid in sorted(set(manifest.data.get("coords", {})) - set(cat["ID"])):
+        print(f"Stale: {catid} is not in the catalog anymore; its charts/cutout may be removed.")
+
+    coos = [manifest.get("coords", catid) or dict(ra=np.nan, dec=np.nan) for catid in cat["ID"]]
+    cat["RA"] = [float(f"{coo['ra']:.4f}") for coo in coos]
+    cat["DEC"] = [float(f"{coo['dec']:.4f}") for coo in coos]
+    cat.to_csv(TOP/"amastro_catalog_radec.csv", index=False)
+
+    # %%
+
+    # style_kwargs = dict(cmap="viridis")
+    # aplt.plot_finder_image(coo[31], fov_radius=30*u.arcmin, grid=True, style_kwargs=style_kwargs, log=True)
+
+    # %%
+    # ****************************************************************************************************** #
+    # *                           DOWNLOAD THUMBNAIL IMAGES FROM WIKI : MESSIER, Caldwell                  * #
+    # ****************************************************************************************************** #
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {}
+        for prefix, page, table_index in WIKI_PAGES:
+            for i, imgurl in enumerate(wiki_thumbnail_urls(args.wiki_url, page, table_index,
+                                                           session)):
+                savepath = SAVEDIR/f"{prefix}_{i+1:03d}.jpg"
+                if savepath.exists():
+                    continue
+                futures[pool.submit(download, imgurl, savepath, session, limiter)] = savepath
+        for future in as_completed(futures):
+            imgurl = future.result()
+            manifest.set("thumbnails", futures[future].name, imgurl)
+            print(imgurl)
 
-    try:
-        _coo = ap.FixedTarget.from_name(catid)
-    except:  # whatever Error occurs...
-        _coo = ap.FixedTarget.from_name(othid)
-    _coo.name = catid + f"({row['Type']})"
-    coo.append(_coo)
-
-    longname = f"{catid} ({othid}, {typekey})"
-    longname += f"\n{name}" if isinstance(name, str) else ""
-    save_finder_plot(SAVEDIR/f"DSS-200px-{catid}.jpg",
-                     longname, _coo.coord, plotkw={"origin": "lower", "cmap": "viridis", "zscale": False})
-    save_finder_plot(SAVEDIR/f"DSS-200px-{catid}-zscale.jpg",
-                     longname, _coo.coord, plotkw={"origin": "lower", "cmap": "viridis", "zscale": True})
-
-
-coo = np.array(coo)
-cat["RA"] = [float(f"{_coo.ra.deg:.4f}") for _coo in coo]
-cat["DEC"] = [float(f"{_coo.dec.deg:.4f}") for _coo in coo]
-cat.to_csv(Path(__file__).parent/"amastro_catalog_radec.csv", index=False)
-
-# %%
-
-
-# style_kwargs = dict(cmap="viridis")
-# aplt.plot_finder_image(coo[31], fov_radius=30*u.arcmin, grid=True, style_kwargs=style_kwargs, log=True)
-
-# %%
-# ********************************************************************************************************** #
-# *                              DOWNLOAD THUMBNAIL IMAGES FROM WIKI : MESSIER                             * #
-# ********************************************************************************************************** #
-url_base = "https://en.wikipedia.org/"
-
-url_main = url_base + "wiki/Messier_object"
-r = requests.get(url_main)
-soup = BeautifulSoup(r.text, 'html.parser')
-table = soup.find_all(class_='wikitable')[0]
-imgs = table.find_all(class_="image")
-
-for i, img in enumerate(imgs):
-    savepath = SAVEDIR/f"Messier_{i+1:03d}.jpg"
-    if savepath.exists():
-        continue
-    imgstr = str(img)
-    imgurl = "https:" + re.split(r"src=", str(imgstr))[1][1:].split('"')[0]
-    print(imgurl)
-    urllib.request.urlretrieve(imgurl, savepath)
-    sleep(0.8)
-
-# %%
-# ********************************************************************************************************** #
-# *                              DOWNLOAD THUMBNAIL IMAGES FROM WIKI : Caldwell                            * #
-# ********************************************************************************************************** #
-url_main = url_base + "wiki/Caldwell_catalogue"
-r = requests.get(url_main)
-soup = BeautifulSoup(r.text, 'html.parser')
-table = soup.find_all(class_='wikitable')[1]
-imgs = table.find_all(class_="image")
-
-for i, img in enumerate(imgs):
-    savepath = SAVEDIR/f"Caldwell_{i+1:03d}.jpg"
-    if savepath.exists():
-        continue
-    imgstr = str(img)
-    imgurl = "https:" + re.split(r"src=", str(imgstr))[1][1:].split('"')[0]
-    print(imgurl)
-    urllib.request.urlretrieve(imgurl, savepath)
-    sleep(0.8)
+    # %%
+    # ****************************************************************************************************** #
+    # *                             PACK THE IMAGES INTO SPRITE SHEETS OF THE REPORT                       * #
+    # ****************************************************************************************************** #
+    # `find_targets.py --self-contained` embeds only the tiles of the visible objects.
+    pack_sprites(SAVEDIR, manifest, quality=args.sprite_quality)
@@ -0,0 +1,87 @@
+''' The closed-form shortcuts of `find_targets.py` against the exact astropy transformation.
+
+    $ python -m pytest tests
+'''
+import sys
+from pathlib import Path
+
+import astropy.units as u
+import numpy as np
+import pytest
+from astropy.coordinates import AltAz, EarthLocation, SkyCoord
+from astropy.time import Time
+
+TOP = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(TOP))
+import find_targets as ft  # noqa: E402
+
+# Within the tables of the bundled IERS data, so that nothing is downloaded.
+OBSTIMES = ["2021-01-15T11:00:00", "2021-06-03T17:30:00", "2021-11-12T11:30:00"]
+LOCATIONS = [(127., 37.5), (-70.7, -30.2), (18.9, 68.3), (-155.5, 19.8)]
+TOL_ALT = 2e-3  # [deg]
+
+
+def random_targets(n, seed):
+    rng = np.random.default_rng(seed)
+    ra = rng.uniform(0, 360, n)
+    dec = np.rad2deg(np.arcsin(rng.uniform(-1, 1, n)))  # uniform on the sky
+    return SkyCoord(ra=ra*u.deg, dec=dec*u.deg)
+
+
+def exact_alt(coo, loc, times):
+    ''' (n_targets, n_times) altitudes [deg] by the full transformation. '''
+    frame = AltAz(obstime=times, location=loc)
+    return coo[:, np.newaxis].transform_to(frame).alt.deg
+
+
+@pytest.mark.parametrize("obstime", OBSTIMES)
+@pytest.mark.parametrize("lon, lat", LOCATIONS)
+def test_altitude_at(lon, lat, obstime):
+    coo = random_targets(1000, seed=1)
+    loc = EarthLocation.from_geodetic(lon*u.deg, lat*u.deg, 500*u.m)
+    obstime = Time(obstime)
+    dhours = np.array([-6, -2.5, 0, 1, 4, 11.5])
+    ha, dec = ft.target_hadec(coo, loc, obstime)
+    alt = ft.altitude_at(ha, dec, lat, dhours)
+    np.testing.assert_allclose(alt, exact_alt(coo, loc, obstime + dhours*u.hour), atol=TOL_ALT)
+
+
+@pytest.mark.parametrize("duration", [0.5, 3, 8])
+@pytest.mark.parametrize("lon, lat", LOCATIONS)
+def test_altitude_range(lon, lat, duration):
+    coo = random_targets(1000, seed=2)
+    loc = EarthLocation.from_geodetic(lon*u.deg, lat*u.deg, 500*u.m)
+    obstime = Time(OBSTIMES[2])
+    ha, dec = ft.target_hadec(coo, loc, obstime)
+    alt_min, alt_max = ft.altitude_range(ha, dec, lat, duration)
+
+    # Every sampled altitude is within the range, ...
+    dhours = np.linspace(-duration, duration, 193)
+    alt = exact_alt(coo, loc, obstime + dhours*u.hour)
+    assert np.all(alt >= alt_min[:, np.newaxis] - TOL_ALT)
+    assert np.all(alt <= alt_max[:, np.newaxis] + TOL_ALT)
+    # ... and the range is reached (up to the change of altitude within half a step: the
+    # altitude changes by at most SIDEREAL_RATE*cos(lat) [deg/hour]).
+    slack = ft.SIDEREAL_RATE*np.cos(np.deg2rad(lat))*(dhours[1] - dhours[0])/2 + TOL_ALT
+    assert np.all(alt.min(axis=1) <= alt_min + slack)
+    assert np.all(alt.max(axis=1) >= alt_max - slack)
+
+
+@pytest.mark.parametrize("duration", [0.5, 3, 12])
+@pytest.mark.parametrize("min_alt", [0, 30, 60])
+@pytest.mark.parametrize("lon, lat", LOCATIONS)
+def test_query_index_superset(lon, lat, min_alt, duration):
+    coo = random_targets(3000, seed=3)
+    cat = ft.pd.DataFrame({"RA": coo.ra.deg, "DEC": coo.dec.deg})
+    index = ft.build_index(cat)
+    loc = EarthLocation.from_geodetic(lon*u.deg, lat*u.deg, 500*u.m)
+    obstime = Time(OBSTIMES[0])
+    # As `find_visible`: the hour-angle cut only for windows shorter than a day.
+    _, alltimes = ft.time_grid(obstime, duration)
+    lst = (None if duration >= 12
+           else alltimes[[0, 2]].sidereal_time("mean", longitude=loc.lon).deg)
+    labels = ft.query_index(index, lat, min_alt, lst=lst)
+
+    alt = exact_alt(coo, loc, obstime + np.linspace(-duration, duration, 97)*u.hour)
+    visible = cat.index[np.any(alt >= min_alt, axis=1)]
+    assert np.isin(visible, labels).all()